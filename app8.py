@@ -1,20 +1,40 @@
 import argparse
 import asyncio
+import base64
 import contextlib
+import gzip
+import hashlib
 import json
+import mimetypes
+import os
+import re
+import signal
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import urllib.request
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from enum import StrEnum
 from pathlib import Path
-from typing import Any, Literal
+from typing import Any, Callable, Literal
 from uuid import uuid4
 import zstandard as zstd
 from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+try: import brotli
+except ImportError: brotli = None
 
 from nicegui import app, ui
 
 from chat_utils3 import (
+    CHAT_PROMPT,
     DEFAULT_MODEL,
+    EDIT_PROMPT,
     DEFAULT_REASONING,
     EXTRACT_ADD_ON,
     MODELS,
@@ -24,37 +44,239 @@ from chat_utils3 import (
     ChatClient,
     ConversationState,
     CouncilEntry,
+    EditDirective,
+    EditEvent,
     EditItem,
     EditRound,
     ExchangeEntry,
+    ConversationStore,
     PendingEdit,
     PromptBuilder,
     ReasoningEvent,
+    TextBuffer,
     UserTurn,
+    ZSTD,
+    STORE_PAGE,
+    STORE_PATH,
+    ZSTD_DICT_PATH,
+    ZstdCodec,
     search_files,
 )
 
 P_PROPS = 'dark outlined dense color=white'
 MD_CLASSES = 'chat7-md max-w-none break-words'
+HYDRATE_TAIL = 8
+INLINE_MARKDOWN = 2048
+MARKDOWN_CACHE_BYTES = 64 << 20
+# Compression Dictionary Transport: browsers that fetched `/chat7-dict/...` get message bodies as `dcz`,
+# zstd against the shared dictionary behind a magic number and the dictionary's SHA-256.
+DCZ_MAGIC = b'\x5e\x2a\x4d\x18\x20\x00\x00\x00'
+DCZ_MATCH = '/chat7-msg/*'
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip', 'application/gzip', 'application/x-gzip', 'application/zstd', 'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed')
 STATIC_DIR = Path(__file__).with_name('static')
-STATIC_V = max((p.stat().st_mtime_ns for p in STATIC_DIR.glob('chat7.*')), default=0)
+ASSET_CACHE_DIR = Path(os.getenv('CHAT_ASSET_CACHE') or Path(tempfile.gettempdir()) / 'chat7-assets')
+ASSET_ENCODINGS: dict[str, Callable[[bytes], bytes] | None] = {
+    'zstd': lambda b: zstd.ZstdCompressor(level=zstd.MAX_COMPRESSION_LEVEL).compress(b),
+    'br': brotli and (lambda b: brotli.compress(b, quality=11)),
+    'gzip': lambda b: gzip.compress(b, 9, mtime=0),
+}
+
+
+@dataclass(slots=True)
+class Asset:
+    name: str
+    digest: str
+    media_type: str
+    bodies: dict[str, bytes]
+
+
+class AssetStore:
+    """Files under `static/`, fingerprinted by content hash and precompressed once per encoding at startup.
+
+    Compressed variants are cached on disk by digest, so restarts skip the work; a variant is kept only if it is smaller.
+    URLs embed the digest, so responses are immutable and repeat loads never reach the server.
+    """
+    def __init__(self, root: Path, cache_dir: Path):
+        self.root, self.cache_dir, self.assets = root, cache_dir, dict[str, Asset]()
+        for path in sorted(root.rglob('*')) if root.is_dir() else []:
+            if path.is_file(): self.add(path)
+
+    def add(self, path: Path):
+        data, name = path.read_bytes(), path.relative_to(self.root).as_posix()
+        digest, bodies = hashlib.blake2b(data, digest_size=8).hexdigest(), {'identity': data}
+        media_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        for enc, compress in ASSET_ENCODINGS.items():
+            if not compress or (media_type.startswith(INCOMPRESSIBLE_TYPES) and '+xml' not in media_type): continue
+            cached = self.cache_dir / f'{digest}.{enc}'
+            try: body = cached.read_bytes()
+            except OSError:
+                body = compress(data)
+                with contextlib.suppress(OSError):
+                    cached.parent.mkdir(parents=True, exist_ok=True)
+                    (tmp := cached.with_name(f'{cached.name}.{uuid4().hex}.tmp')).write_bytes(body)
+                    tmp.replace(cached)
+            if len(body) < len(data): bodies[enc] = body
+        self.assets[name] = Asset(name, digest, media_type, bodies)
+
+    def url(self, name: str) -> str: return f'/chat7-static/{a.digest if (a := self.assets.get(name)) else "0"}/{name}'
+
+    def response(self, digest: str, name: str, request: Request) -> Response:
+        if not (a := self.assets.get(name)): return Response(status_code=404)
+        accepted = {t.split(';')[0].strip().lower() for t in request.headers.get('accept-encoding', '').split(',')}
+        enc = next((e for e in ('zstd', 'br', 'gzip') if e in a.bodies and e in accepted), 'identity')
+        # A stale digest (page rendered before a redeploy) still gets the current file, just not cached for good.
+        headers = {'ETag': f'"{a.digest}-{enc}"', 'Vary': 'Accept-Encoding', 'Cache-Control': 'public, max-age=31536000, immutable' if digest == a.digest else 'no-cache'}
+        if enc != 'identity': headers['Content-Encoding'] = enc
+        if request.headers.get('if-none-match') == headers['ETag']: return Response(status_code=304, headers=headers)
+        return Response(a.bodies[enc], media_type=a.media_type, headers=headers)
+
+
+STATIC_ASSETS = AssetStore(STATIC_DIR, ASSET_CACHE_DIR)
+CDN = 'https://cdn.jsdelivr.net'
+HLJS = f'{CDN}/gh/highlightjs/cdn-release@11.11.1/build'
+# Language packs beyond highlight.js's common bundle, fetched the first time a fence names one (or an alias).
+HLJS_LANGUAGES = ('apache', 'armasm', 'awk', 'clojure', 'cmake', 'dart', 'django', 'dockerfile', 'elixir', 'elm', 'erlang', 'fortran', 'fsharp', 'gradle', 'groovy', 'haskell', 'julia', 'latex', 'lisp', 'llvm', 'matlab', 'nginx', 'nix', 'ocaml', 'powershell', 'prolog', 'protobuf', 'scala', 'scheme', 'tcl', 'verilog', 'vhdl', 'vim', 'x86asm', 'zephir')
+HLJS_ALIASES = {'docker': 'dockerfile', 'ex': 'elixir', 'exs': 'elixir', 'erl': 'erlang', 'clj': 'clojure', 'f90': 'fortran', 'fs': 'fsharp', 'hs': 'haskell', 'jl': 'julia', 'tex': 'latex', 'ml': 'ocaml', 'ps': 'powershell', 'ps1': 'powershell', 'proto': 'protobuf', 'nasm': 'x86asm'}
+KATEX_FONTS = ('AMS-Regular', 'Caligraphic-Bold', 'Caligraphic-Regular', 'Fraktur-Bold', 'Fraktur-Regular', 'Main-Bold', 'Main-BoldItalic', 'Main-Italic', 'Main-Regular', 'Math-BoldItalic', 'Math-Italic', 'SansSerif-Bold', 'SansSerif-Italic', 'SansSerif-Regular', 'Script-Regular', 'Size1-Regular', 'Size2-Regular', 'Size3-Regular', 'Size4-Regular', 'Typewriter-Regular')
+# Front-end libraries by their path under `static/`, pinned to the upstream copy `--vendor` fetches.
+VENDOR = {
+    'vendor/markdown-it.min.js': f'{CDN}/npm/markdown-it@14.1.0/dist/markdown-it.min.js',
+    'vendor/highlight.min.js': f'{HLJS}/highlight.min.js',
+    'vendor/github-dark.min.css': f'{HLJS}/styles/github-dark.min.css',
+    'vendor/purify.min.js': f'{CDN}/npm/dompurify@3.1.7/dist/purify.min.js',
+    'vendor/katex/katex.min.js': f'{CDN}/npm/katex@0.16.11/dist/katex.min.js',
+    'vendor/katex/katex.min.css': f'{CDN}/npm/katex@0.16.11/dist/katex.min.css',
+    'vendor/texmath.min.js': f'{CDN}/npm/markdown-it-texmath@1.0.0/texmath.min.js',
+    'vendor/texmath.min.css': f'{CDN}/npm/markdown-it-texmath@1.0.0/css/texmath.min.css',
+    'vendor/mermaid.min.js': f'{CDN}/npm/mermaid@11.6.0/dist/mermaid.min.js',
+    'vendor/inter.woff2': f'{CDN}/npm/@fontsource-variable/inter@5.1.0/files/inter-latin-wght-normal.woff2',
+    **{f'vendor/katex/fonts/KaTeX_{f}.woff2': f'{CDN}/npm/katex@0.16.11/dist/fonts/KaTeX_{f}.woff2' for f in KATEX_FONTS},
+    **{f'vendor/hljs/{l}.min.js': f'{HLJS}/languages/{l}.min.js' for l in HLJS_LANGUAGES},
+}
+
+
+def asset(name: str) -> str: return STATIC_ASSETS.url(name) if name in STATIC_ASSETS.assets else VENDOR[name]
+
+
+def vendor_assets(root: Path = STATIC_DIR):
+    """Download every pinned `VENDOR` file missing under `root`, so the page needs no CDN."""
+    for name, url in VENDOR.items():
+        if (path := root / name).exists(): continue
+        with urllib.request.urlopen(url, timeout=60) as r: data = r.read()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        (tmp := path.with_name(f'{path.name}.{uuid4().hex}.tmp')).write_bytes(data)
+        tmp.replace(path)
+        print(f'{name}: {len(data)} bytes')
+
+
+def train_zstd_dict(paths: list[str], out: Path = ZSTD_DICT_PATH, chunk: int = 16 << 10):
+    """Train the shared zstd dictionary from the prompts plus a corpus (exported conversations, the edited sources)."""
+    files = [f for p in map(Path, paths) for f in ([p] if p.is_file() else sorted(p.rglob('*'))) if f.is_file()]
+    samples = [t.encode() for t in (CHAT_PROMPT, EDIT_PROMPT, EXTRACT_ADD_ON)] + [b[i:i + chunk] for f in files for b in [f.read_bytes()] for i in range(0, len(b), chunk)]
+    data = ZstdCodec.train(samples)
+    if old := ZstdCodec.retire(out): print(f'{old}: previous dictionary, kept for reading data written with it')
+    out.write_bytes(data)
+    print(f'{out}: {len(data)} bytes from {len(samples)} samples')
+
+
+# Only the sanitizer, the stylesheets and chat7.js load with the page; markdown-it and highlight.js load in the
+# render workers, and KaTeX, mermaid and extra highlight.js languages the first time a message uses them.
+CHAT7_ASSETS = {
+    'core': [asset('vendor/markdown-it.min.js'), asset('vendor/highlight.min.js')],
+    'math': [asset('vendor/katex/katex.min.js'), asset('vendor/texmath.min.js')],
+    'mathCss': [asset('vendor/katex/katex.min.css'), asset('vendor/texmath.min.css')],
+    'mermaid': [asset('vendor/mermaid.min.js')],
+    'langs': {**{l: asset(f'vendor/hljs/{l}.min.js') for l in HLJS_LANGUAGES}, **{a: asset(f'vendor/hljs/{l}.min.js') for a, l in HLJS_ALIASES.items()}},
+}
 HEAD_ASSETS = f'''
-<link rel="preconnect" href="https://fonts.googleapis.com"><link rel="preconnect" href="https://fonts.gstatic.com" crossorigin><link rel="stylesheet" href="https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap">
-<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.css">
-<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/markdown-it-texmath/css/texmath.min.css">
-<link rel="stylesheet" href="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.11.1/build/styles/github-dark.min.css">
-<link rel="stylesheet" href="/chat7-static/chat7.css?v={STATIC_V}">
-<script defer src="https://cdn.jsdelivr.net/npm/markdown-it@14.1.0/dist/markdown-it.min.js"></script>
-<script defer src="https://cdn.jsdelivr.net/gh/highlightjs/cdn-release@11.11.1/build/highlight.min.js"></script>
-<script defer src="https://cdn.jsdelivr.net/npm/dompurify@3.1.7/dist/purify.min.js"></script>
-<script defer src="https://cdn.jsdelivr.net/npm/mermaid@11.6.0/dist/mermaid.min.js"></script>
-<script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.js"></script>
-<script defer src="https://cdn.jsdelivr.net/npm/markdown-it-texmath/texmath.min.js"></script>
-<script defer src="/chat7-static/chat7.js?v={STATIC_V}"></script>
+<link rel="preload" href="{asset('vendor/inter.woff2')}" as="font" type="font/woff2" crossorigin>
+<style>@font-face {{ font-family: 'Inter'; font-style: normal; font-weight: 100 900; font-display: swap; src: url({asset('vendor/inter.woff2')}) format('woff2'); }}</style>
+<link rel="stylesheet" href="{asset('vendor/github-dark.min.css')}">
+<link rel="stylesheet" href="{STATIC_ASSETS.url('chat7.css')}">
+<script defer src="{asset('vendor/purify.min.js')}"></script>
+{f'<link rel="compression-dictionary" href="/chat7-dict/{ZSTD.sha256.hex()}">' if ZSTD.data else ''}
+<script>window.chat7Assets = {json.dumps(CHAT7_ASSETS)};</script>
+<script defer src="{STATIC_ASSETS.url('chat7.js')}"></script>
 '''
-if STATIC_DIR.is_dir():
-    try: app.add_static_files('/chat7-static', str(STATIC_DIR))
-    except (RuntimeError, ValueError): pass
+
+
+@app.get('/chat7-static/{digest}/{name:path}')
+def chat7_static(digest: str, name: str, request: Request): return STATIC_ASSETS.response(digest, name, request)
+
+
+class MarkdownCache:
+    """Content-addressed message bodies served from `/chat7-msg/{key}`, evicted LRU by total size.
+
+    Keys are blake2b digests of the text, so they double as ETags and responses can be cached as immutable. The ETags
+    are weak since the same body goes out zstd/dcz-encoded or not, and the response varies by those request headers.
+    """
+    def __init__(self, max_bytes: int = MARKDOWN_CACHE_BYTES): self.items, self.size, self.max_bytes, self.lock = OrderedDict[str, bytes](), 0, max_bytes, threading.Lock()
+
+    def put(self, text: str) -> str:
+        data = text.encode('utf-8')
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        with self.lock:
+            if key in self.items: self.items.move_to_end(key)
+            else: self.items[key], self.size = data, self.size + len(data)
+            while self.size > self.max_bytes and len(self.items) > 1: self.size -= len(self.items.popitem(last=False)[1])
+        return key
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            if (data := self.items.get(key)) is not None: self.items.move_to_end(key)
+            return data
+
+
+MARKDOWN_CACHE = MarkdownCache()
+
+
+class FlushScheduler:
+    """One loop shared by every tab, running only while some tab has live runs.
+
+    Runs mark their controller dirty as chunks arrive; dirty controllers are flushed at most `fps` times a second and
+    controllers with live runs get their elapsed-time labels ticked once a second. Idle tabs cost nothing.
+    """
+    def __init__(self, fps: int = 60): self.period, self.dirty, self.live, self.task = 1 / fps, dict[int, Any](), dict[int, Any](), None
+
+    def mark(self, page: Any):
+        self.dirty[id(page)] = self.live[id(page)] = page
+        if not self.task or self.task.done(): self.task = asyncio.create_task(self.loop())
+
+    async def loop(self):
+        tick_at = time.monotonic() + 1.0
+        while self.dirty or self.live:
+            await asyncio.sleep(self.period)
+            dirty, self.dirty, tick = self.dirty, {}, time.monotonic() >= tick_at
+            if tick: tick_at = time.monotonic() + 1.0
+            for key, page in list((self.live | dirty).items() if tick else dirty.items()):
+                if page.view.client.is_deleted:
+                    self.live.pop(key, None)
+                    continue
+                try:
+                    with page.view.client:
+                        if key in dirty: page.flush_updates()
+                        if tick: page.tick_timer()
+                except Exception as e: app.handle_exception(e)
+                if not page.live_runs(): self.live.pop(key, None)
+
+
+FLUSHER = FlushScheduler()
+STORE = ConversationStore(STORE_PATH, on_error=app.handle_exception)
+OPEN_CONVERSATIONS: dict[str, Any] = {}  # conversation id -> the ChatPageController (tab) of this process that has it open
+
+
+@app.get('/chat7-dict/{digest}')
+def chat7_dictionary(digest: str):
+    if not ZSTD.data or digest != ZSTD.sha256.hex(): return Response(status_code=404)
+    return Response(ZSTD.data, media_type='application/octet-stream', headers={'Use-As-Dictionary': f'match="{DCZ_MATCH}", id="{digest}"', 'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+@app.get('/chat7-msg/{key}')
+def chat7_message(key: str, request: Request):
+    if (data := MARKDOWN_CACHE.get(key)) is None: return Response(status_code=404)
+    headers = {'ETag': f'W/"{key}"', 'Vary': 'Accept-Encoding, Available-Dictionary' if ZSTD.data else 'Accept-Encoding', 'Cache-Control': 'private, max-age=31536000, immutable'}
+    if f'"{key}"' in request.headers.get('if-none-match', ''): return Response(status_code=304, headers=headers)
+    return Response(data, media_type='text/markdown; charset=utf-8', headers=headers)
 
 
 class Phase(StrEnum):
@@ -87,16 +309,20 @@ class LiveRun:
     target_id: str
     task: asyncio.Task | None = None
     renderer: Any = None
+    validator: Any = None
+    checks: asyncio.Task | None = None  # the latest of the validator's checks, each chained after the one before
     started_at: float = 0.0
-    reasoning: str = ''
-    reasoning_delta: str = ''
-    display_delta: str = ''
-    raw_buffer: str = ''
+    reasoning: TextBuffer = field(default_factory=TextBuffer)
+    reasoning_delta: TextBuffer = field(default_factory=TextBuffer)
+    display_delta: TextBuffer = field(default_factory=TextBuffer)
+    display: TextBuffer = field(default_factory=TextBuffer)
+    raw_buffer: TextBuffer = field(default_factory=TextBuffer)
     has_answer: bool = False
     done: bool = False
     error: str | None = None
     interrupted: bool = False
     reset_display: bool = False
+    dirty: bool = False
 
 
 @dataclass(slots=True)
@@ -116,6 +342,7 @@ class UiRefs:
     model_button: Any = None
     model_menu: Any = None
     model_menu_body: Any = None
+    history_menu_body: Any = None
     reasoning_select: Any = None
     mode_select: Any = None
     stop_btn: Any = None
@@ -126,7 +353,12 @@ class UiRefs:
     edit_slots: dict[str, Any] = field(default_factory=dict)
     timer_labels: dict[str, Any] = field(default_factory=dict)
     status_chips: dict[str, tuple[Any, Any]] = field(default_factory=dict)
+    chip_status: dict[str, str] = field(default_factory=dict)
     order: list[str] = field(default_factory=list)
+    synced: list[tuple[Any, int]] = field(default_factory=list)  # (entry, its token count) per entry behind `order`
+    synced_at: tuple[Any, int] = (None, 0)  # the conversation and its offset as of the last sync
+    slots: dict[str, Any] = field(default_factory=dict)
+    specs: dict[str, Callable[[], dict[str, Any]]] = field(default_factory=dict)
 
 
 def new_id() -> str: return uuid4().hex
@@ -136,23 +368,34 @@ def int_or(x: Any, d: int = 0) -> int:
 
 
 class ChatPageView:
-    def __init__(self, page: 'ChatPageController'): self.page = page
+    def __init__(self, page: 'ChatPageController'): self.page, self.client, self.outbox = page, ui.context.client, []
 
     def js_call(self, method: str, *args: Any):
-        s = ', '.join(json.dumps(a) for a in args)
-        ui.run_javascript(f'(() => {{ const f = n => window.chat7 ? window.chat7.{method}({s}) : n > 0 && setTimeout(() => f(n - 1), 50); f(40); }})();')
+        # Calls made during one event-loop tick leave as a single batch for `chat7.dispatch`; consecutive appends to
+        # the same node are merged into one chunk.
+        if self.outbox and method in {'appendMarkdown', 'appendMarkdownBuffered'} and self.outbox[-1][:2] == [method, args[0]]: self.outbox[-1][2] += args[1]
+        else: self.outbox.append([method, *args])
+        if len(self.outbox) == 1: asyncio.get_running_loop().call_soon(self.flush_js)
+
+    def flush_js(self):
+        batch, self.outbox = self.outbox, []
+        if batch: self.client.run_javascript(f'(window.chat7q ||= []).push({json.dumps(batch)}); window.chat7?.dispatch();')
 
     def set_markdown(self, content_id: str, text: str, now: bool = False): self.js_call('setMarkdown', content_id, text, now)
     def append_markdown(self, content_id: str, chunk: str): self.js_call('appendMarkdown', content_id, chunk)
+    def load_markdown(self, content_id: str, text: str):
+        # Large settled bodies go over HTTP from the content-addressed cache (browser-cached across reloads) rather than the websocket.
+        if len(text) <= INLINE_MARKDOWN: return self.set_markdown(content_id, text, True)
+        self.js_call('loadMarkdown', content_id, f'/chat7-msg/{MARKDOWN_CACHE.put(text)}')
     def append_markdown_buffered(self, content_id: str, chunk: str): self.js_call('appendMarkdownBuffered', content_id, chunk)
     def finish_markdown_buffered(self, content_id: str): self.js_call('finishMarkdownBuffered', content_id)
-    def focus_input(self): ui.run_javascript('document.getElementById("input-field")?.querySelector("textarea")?.focus()')
-    def focus_file_search(self): ui.run_javascript('document.querySelector("#file-search")?.focus()')
+    def focus_input(self): self.js_call('focus', 'input-field')
+    def focus_file_search(self): self.js_call('focus', 'file-search')
     def scroll_bottom(self): self.js_call('scrollBottom')
 
     def scroll_active_into_view(self):
         p = self.page
-        if p.page.search_idx >= 0: ui.run_javascript(f'document.getElementById("file-opt-{p.page.search_idx}")?.scrollIntoView({{block:"nearest"}});')
+        if p.page.search_idx >= 0: self.js_call('reveal', f'file-opt-{p.page.search_idx}')
 
     def clear_search_results(self):
         p = self.page
@@ -162,7 +405,8 @@ class ChatPageView:
     def clear_rendered_messages(self):
         p = self.page
         if p.refs.container: p.refs.container.clear()
-        p.refs.nodes.clear(), p.refs.content_ids.clear(), p.refs.edit_slots.clear(), p.refs.timer_labels.clear(), p.refs.status_chips.clear(), p.refs.order.clear()
+        p.refs.nodes.clear(), p.refs.content_ids.clear(), p.refs.edit_slots.clear(), p.refs.timer_labels.clear(), p.refs.status_chips.clear(), p.refs.chip_status.clear(), p.refs.order.clear(), p.refs.slots.clear(), p.refs.specs.clear()
+        p.refs.synced, p.refs.synced_at = [], (None, 0)
 
     def update_controls(self):
         p, phase = self.page, self.page.phase()
@@ -193,6 +437,21 @@ class ChatPageView:
                 ui.separator().classes('w-full my-1')
                 ui.button('Clear council selection', on_click=p.clear_council_selection).props('flat dense size=sm color=grey').classes('mx-3 mb-2')
 
+    async def refresh_conversations(self):
+        p, rows = self.page, await STORE.conversations()
+        if not p.refs.history_menu_body: return
+        p.refs.history_menu_body.clear()
+        with p.refs.history_menu_body:
+            if not rows: ui.label('No saved conversations').classes('text-gray-500 p-2')
+            for c in rows:
+                row = ui.row().classes('w-96 items-center justify-between gap-3 px-3 py-2 rounded cursor-pointer hover:bg-gray-800')
+                row.on('click', lambda _=None, x=c['id']: p.open_conversation(x))
+                with row:
+                    with ui.row().classes('items-center gap-2 min-w-0 flex-nowrap'):
+                        ui.icon('check', size='16px').classes('text-blue-300' if c['id'] == p.conversation.id else 'opacity-0')
+                        ui.label(c['title'] or 'Untitled').classes('text-sm text-gray-200 truncate')
+                    ui.label(f"{c['entries']} · {time.strftime('%b %d %H:%M', time.localtime(c['updated']))}").classes('text-xs text-gray-500 whitespace-nowrap')
+
     def render_pending_attachments(self):
         p = self.page
         if not p.refs.attachments: return
@@ -216,15 +475,17 @@ class ChatPageView:
         r = p.conversation.edit_rounds.get(assistant_id)
         if not r: return
         icon, cls, label = p.edit_round_meta(r.status)
+        pe = p.conversation.pending_edit if r.status == 'pending' and p.conversation.pending_edit and p.conversation.pending_edit.assistant_id == assistant_id else None
+        if pe and pe.checked: label = f'{label} · {pe.resolved}/{pe.checked} anchors resolved'
         with slot:
             with ui.element('div').classes('tool-att'):
                 ui.icon(icon).classes(cls)
                 ui.label(label).classes('tool-att-label text-gray-300')
-                if r.status == 'pending' and p.conversation.pending_edit and p.conversation.pending_edit.assistant_id == assistant_id:
+                if pe:
                     ui.button('Apply', on_click=lambda i=assistant_id: asyncio.create_task(p.apply_pending_edits(i))).props('flat dense size=sm color=positive').classes('ml-1')
             if r.status != 'pending':
                 for it in r.items:
-                    icon, cls = ('check', 'text-green-400') if it.status == 'success' else ('warning', 'text-amber-400') if it.status == 'partial' else ('close', 'text-red-400')
+                    icon, cls = ('check', 'text-green-400') if it.status == 'success' else ('warning', 'text-amber-400') if it.status == 'partial' else ('schedule', 'text-gray-400') if it.status == 'pending' else ('save', 'text-blue-300') if it.status == 'staged' else ('close', 'text-red-400')
                     with ui.element('div').classes('tool-att'):
                         ui.icon(icon).classes(cls)
                         ui.label(Path(it.label).name or it.label).classes('tool-att-label text-gray-300')
@@ -242,14 +503,18 @@ class ChatPageView:
         return chip
 
     def set_assistant_status(self, assistant_id: str, status: str | None):
-        if not (chips := self.page.refs.status_chips.get(assistant_id)): return
+        refs = self.page.refs
+        if not (chips := refs.status_chips.get(assistant_id)): return refs.chip_status.pop(assistant_id, None)
+        if refs.chip_status.get(assistant_id) == status: return
         chips[0].set_visibility(status == 'thinking')
         chips[1].set_visibility(status == 'answering')
+        if status: refs.chip_status[assistant_id] = status
+        else: refs.chip_status.pop(assistant_id, None)
     def build_tools(self, content_id: str, atts: list[Attachment] | None = None, assistant_id: str | None = None, timer_id: str | None = None, timer_value: int | None = None, status_id: str | None = None):
         p = self.page
         with ui.element('div').classes('answer-tools flex items-center gap-2 flex-wrap'):
             if status_id:
-                t, a = self.robot_chip('thinking'), self.robot_chip('answering'); t.set_visibility(False); a.set_visibility(False); p.refs.status_chips[status_id] = (t, a)
+                t, a = self.robot_chip('thinking'), self.robot_chip('answering'); t.set_visibility(False); a.set_visibility(False); p.refs.status_chips[status_id] = (t, a); p.refs.chip_status.pop(status_id, None)
             ui.button('', on_click=lambda i=content_id, b=f'{content_id}-copy': self.js_call('copyMarkdown', i, b)).props(f'icon=content_copy flat dense size=sm id={content_id}-copy').classes('tool-btn copy-icon')
             for a in atts or []:
                 text = Path(a.path).name if a.kind == 'file' else a.url
@@ -269,9 +534,9 @@ class ChatPageView:
         if token in p.refs.nodes: return
         content_id = f'msg8-{len(p.refs.content_ids)}-{time.time_ns()}'
         p.refs.content_ids[token] = content_id
-        with p.refs.container:
+        with p.refs.slots.get(token) or p.refs.container:
             wrap = ui.column().classes('w-full gap-1')
-            p.refs.nodes[token], p.refs.order = wrap, p.refs.order + [token]
+            p.refs.nodes[token] = wrap
             with wrap:
                 ui.label(label).classes('text-[11px] text-gray-500 px-1')
                 if role == 'user':
@@ -286,22 +551,97 @@ class ChatPageView:
                             ui.element('div').props(f'id={content_id}').classes(f'{MD_CLASSES} text-white')
                     with ui.element('div').classes('flex justify-start answer-tools-row mb-3'):
                         self.build_tools(content_id, assistant_id=assistant_id, timer_id=timer_id, timer_value=timer_value, status_id=timer_id)
-        self.set_markdown(content_id, content, True)
+        self.set_markdown(content_id, content, True) if token in self.live_tokens() else self.load_markdown(content_id, content)
 
-    def render_history(self):
+    def entry_specs(self, e: ExchangeEntry | CouncilEntry) -> list[tuple[str, Callable[[], dict[str, Any]]]]:
         p = self.page
-        self.clear_rendered_messages()
-        for e in p.conversation.entries:
-            if isinstance(e, ExchangeEntry):
-                self.render_message(p.exchange_user_token(e), 'user', e.user.display_text, 'You', e.user.attachments)
-                self.render_message(p.exchange_assistant_token(e), 'assistant', p.assistant_display(e.assistant), e.assistant.label or e.assistant.model, assistant_id=e.assistant.id, timer_id=e.assistant.id, timer_value=p.assistant_timer_value(e.assistant.id))
-                continue
-            self.render_message(p.council_user_token(e), 'user', e.query.display_text, 'You · council', e.query.attachments)
-            for m in e.members: self.render_message(p.council_member_token(e, m), 'assistant', p.assistant_display(m), m.label or m.model, timer_id=m.id, timer_value=p.assistant_timer_value(m.id))
-            if e.synthesis: self.render_message(p.council_synthesis_token(e), 'assistant', p.assistant_display(e.synthesis), e.synthesis.label or e.synthesis.model, assistant_id=e.synthesis.id, timer_id=e.synthesis.id, timer_value=p.assistant_timer_value(e.synthesis.id))
-        for aid in list(p.refs.status_chips): self.set_assistant_status(aid, p.assistant_status(aid))
+        if isinstance(e, ExchangeEntry):
+            return [(p.exchange_user_token(e), lambda: dict(role='user', content=e.user.display_text, label='You', atts=e.user.attachments)),
+                    (p.exchange_assistant_token(e), lambda: dict(role='assistant', content=p.assistant_display(e.assistant), label=e.assistant.label or e.assistant.model, assistant_id=e.assistant.id, timer_id=e.assistant.id, timer_value=p.assistant_timer_value(e.assistant.id)))]
+        out = [(p.council_user_token(e), lambda: dict(role='user', content=e.query.display_text, label='You · council', atts=e.query.attachments))]
+        for m in e.members: out.append((p.council_member_token(e, m), lambda m=m: dict(role='assistant', content=p.assistant_display(m), label=m.label or m.model, timer_id=m.id, timer_value=p.assistant_timer_value(m.id))))
+        if e.synthesis: out.append((p.council_synthesis_token(e), lambda: dict(role='assistant', content=p.assistant_display(e.synthesis), label=e.synthesis.label or e.synthesis.model, assistant_id=e.synthesis.id, timer_id=e.synthesis.id, timer_value=p.assistant_timer_value(e.synthesis.id))))
+        return out
+
+    def live_tokens(self) -> set[str]:
+        p = self.page
+        return {p.locate_assistant(r.target_id)[2] for r in p.live_runs()}
+
+    def mount_message(self, token: str):
+        p = self.page
+        if token in p.refs.nodes or token not in p.refs.specs: return
+        self.render_message(token, **(spec := p.refs.specs[token]()))
+        if (aid := spec.get('timer_id')) in p.refs.status_chips: self.set_assistant_status(aid, p.assistant_status(aid))
+
+    def unmount_message(self, token: str):
+        p = self.page
+        if token not in p.refs.nodes or token in self.live_tokens() or not (slot := p.refs.slots.get(token)): return
+        spec = p.refs.specs[token]()
+        slot.clear()
+        p.refs.nodes.pop(token, None), p.refs.content_ids.pop(token, None)
+        p.refs.timer_labels.pop(spec.get('timer_id'), None), p.refs.status_chips.pop(spec.get('timer_id'), None), p.refs.edit_slots.pop(spec.get('assistant_id'), None)
+
+    def markdown_miss(self, args: dict[str, Any]):
+        p = self.page
+        if (token := next((t for t, i in p.refs.content_ids.items() if i == args.get('id')), None)) and token in p.refs.specs: self.set_markdown(p.refs.content_ids[token], p.refs.specs[token]()['content'], True)
+
+    def sync_slots(self, args: dict[str, Any]):
+        for token in args.get('unmount') or []: self.unmount_message(token)
+        mounted = [t for t in args.get('mount') or [] if t in self.page.refs.specs and t not in self.page.refs.nodes]
+        for token in mounted: self.mount_message(token)
+        if mounted: self.js_call('slotsMounted', mounted)
+        if self.page.conversation.offset and self.page.refs.order and self.page.refs.order[0] in mounted: asyncio.create_task(self.page.load_older())
+
+    def drop_slot(self, token: str):
+        p = self.page
+        spec, slot = p.refs.specs.pop(token)(), p.refs.slots.pop(token)
+        p.refs.nodes.pop(token, None), p.refs.content_ids.pop(token, None)
+        p.refs.timer_labels.pop(spec.get('timer_id'), None), p.refs.status_chips.pop(spec.get('timer_id'), None), p.refs.edit_slots.pop(spec.get('assistant_id'), None)
+        slot.delete()
+
+    def add_slots(self, specs: list[tuple[str, Callable[[], dict[str, Any]]]], index: int) -> list[str]:
+        # Slots for `specs` from container position `index` on: existing ones are kept, new ones moved into place.
+        p = self.page
+        for k, (token, spec) in enumerate(specs):
+            p.refs.specs[token] = spec
+            if token in p.refs.slots: continue
+            text = spec()['content'] or ''
+            estimate = min(4000, 72 + 22 * (text.count('\n') + len(text) // 90))
+            with p.refs.container: p.refs.slots[token] = ui.element('div').props(f'data-token={token} data-estimate={estimate}').classes('chat7-slot w-full')
+            if index + k < len(p.refs.slots) - 1: p.refs.slots[token].move(target_index=index + k)
+        return [t for t, _ in specs]
+
+    def sync_history(self, scroll: bool = True):
+        # Keyed reconciliation of the transcript against `refs.order`, diffing only what moved since the last sync:
+        # entries prepended by paging, and the tail from the last entry that is unchanged (entries only change at the
+        # end: appended, undone, or grown by a synthesis). Slots of vanished messages are deleted, new ones are
+        # inserted at their position, and existing ones (and their rendered markdown) are left alone.
+        # Only the tail and live runs are built up front; the client mounts the rest as they near the viewport
+        # and hands far-away ones back (see `observeSlots` in chat7.js).
+        p, s = self.page, self.page.conversation
+        (conversation, offset), size = p.refs.synced_at, lambda e: 1 + len(ConversationState.turns(e))
+        old = p.refs.synced if conversation is s and offset >= s.offset else []
+        head = offset - s.offset if old else 0
+        i = max(0, min(len(old), len(s.entries) - head))
+        while i > 0 and (old[i - 1][0] is not s.entries[head + i - 1] or old[i - 1][1] != size(old[i - 1][0])): i -= 1
+        kept = len(p.refs.order) - sum(n for _, n in old[i:]) if old else 0
+        new_head, new_tail = s.entries[:head], s.entries[head + i:]
+        tail = [x for e in new_tail for x in self.entry_specs(e)]
+        for token in set(p.refs.order[kept:]) - {t for t, _ in tail}: self.drop_slot(token)
+        del p.refs.order[kept:], old[i:]
+        p.refs.order[:0] = self.add_slots([x for e in new_head for x in self.entry_specs(e)], 0)
+        p.refs.order += self.add_slots(tail, len(p.refs.order))
+        old[:0], old[len(old):] = [(e, size(e)) for e in new_head], [(e, size(e)) for e in new_tail]
+        p.refs.synced, p.refs.synced_at = old, (s, s.offset)
+        for token in dict.fromkeys([*p.refs.order[-HYDRATE_TAIL:], *self.live_tokens()]): self.mount_message(token)
+        for aid in {*p.refs.chip_status, *(r.target_id for r in p.live_runs())}: self.set_assistant_status(aid, p.assistant_status(aid))
         self.update_controls()
-        self.scroll_bottom()
+        self.js_call('observeSlots')
+        if scroll: self.scroll_bottom()
+
+    def render_history(self):
+        self.clear_rendered_messages()
+        self.sync_history()
 
     def render_search_results(self):
         p = self.page
@@ -327,6 +667,10 @@ class ChatPageView:
                     p.refs.model_button = ui.button(p.model_button_text(), icon='smart_toy').props('dark outline dense color=white').classes('text-white w-72 header-control header-model-btn')
                     with ui.menu() as p.refs.model_menu:
                         p.refs.model_menu_body = ui.column().classes('gap-0 p-1')
+                with ui.element('div').classes('relative'):
+                    ui.button(icon='history', on_click=self.refresh_conversations).props('dark outline dense color=white').classes('text-white header-control')
+                    with ui.menu():
+                        p.refs.history_menu_body = ui.column().classes('gap-0 p-1')
                 p.refs.reasoning_select = ui.select(REASONING_LEVELS, label='Reasoning').props(P_PROPS).classes('text-white w-32 header-control').bind_value(p.page, 'reasoning')
                 with ui.element('div').classes('flex-grow relative'):
                     p.refs.file_search = ui.input(placeholder='Search files or paste URL...').props(f'{P_PROPS} debounce=250 id=file-search').classes('w-full header-control')
@@ -372,11 +716,28 @@ class ChatPageController:
     @classmethod
     def load(cls, storage: Any):
         c, p = storage.get('conversation9'), storage.get('page9')
-        x = cls(storage, c if isinstance(c, ConversationState) else ConversationState(), p if isinstance(p, PageState) else PageState())
+        x = cls(storage, ConversationState(), p if isinstance(p, PageState) else PageState())
+        try: x.take(c if isinstance(c, ConversationState) else x.conversation)
+        except RuntimeError as e:  # another tab or worker process has the conversation; this tab starts afresh
+            ui.notify(str(e), type='warning')
+            x.take(ConversationState())
         x.normalize_state()
-        storage['conversation9'], storage['page9'] = x.conversation, x.page
+        storage['page9'] = x.page
         return x
 
+    def take(self, s: ConversationState):
+        """Make `s` this tab's conversation. Raises RuntimeError if another tab or worker process has it open, as both
+        would write the same entry rows; a reload of the same tab takes it over from its old client."""
+        if (other := OPEN_CONVERSATIONS.get(s.id)) is not None and other is not self and other.storage is not self.storage: raise RuntimeError('This conversation is open in another tab')
+        self.chat.open_journal(s.journal_id)
+        if OPEN_CONVERSATIONS.get(self.conversation.id) is self: del OPEN_CONVERSATIONS[self.conversation.id]
+        OPEN_CONVERSATIONS[s.id], self.conversation = self, s
+        self.storage['conversation9'] = s
+
+    def close(self):
+        if OPEN_CONVERSATIONS.get(self.conversation.id) is self: del OPEN_CONVERSATIONS[self.conversation.id]
+        self.chat.close()
+
     def normalize_state(self):
         if self.page.model not in MODELS: self.page.model = DEFAULT_MODEL
         if self.page.reasoning not in REASONING_LEVELS: self.page.reasoning = DEFAULT_REASONING
@@ -385,6 +746,7 @@ class ChatPageController:
         self.page.url_attachments = [a for a in (self.page.url_attachments or []) if isinstance(a, Attachment) and a.kind == 'url' and a.url.strip()]
         self.page.council_counts = {m: max(1, int_or(n, 0)) for m, n in (self.page.council_counts or {}).items() if m in MODELS and int_or(n, 0) > 0}
         self.page.search_results, self.page.search_idx = [str(x) for x in (self.page.search_results or []) if str(x).strip()], int_or(self.page.search_idx, -1)
+        self.conversation.reindex()
         self.prune_state()
         self.reconcile_entries()
 
@@ -407,6 +769,7 @@ class ChatPageController:
     def council_synthesis_token(self, c: CouncilEntry) -> str: return f'c:{c.id}:s'
 
     def assistant_display(self, a: AssistantTurn) -> str:
+        if (r := self.run_for_assistant(a.id)) and r.has_answer and not a.finalized: return str(r.display).rstrip()
         return (a.display_text or a.raw_text).rstrip() or ('Response stopped.' if a.finalized else '')
 
     def assistant_timer_value(self, assistant_id: str) -> int:
@@ -424,47 +787,75 @@ class ChatPageController:
         self.page.file_attachments = [a.path.strip().replace('\\', '/') for a in atts if a.kind == 'file' and a.path.strip()]
         self.page.url_attachments = [Attachment('url', url=a.url, content=a.content) for a in atts if a.kind == 'url' and a.url.strip()]
 
-    def edit_targets(self, text: str) -> list[str]:
+    def edit_targets(self, directives: list[EditDirective]) -> list[str]:
         out = []
-        for d in self.chat.parse_edit_markdown(text or '') or []:
+        for d in directives:
             x = (d.filename or '').strip().replace('\\', '/')
             if x and x not in out: out.append(x)
         return out
 
     def edit_round_meta(self, status: str) -> tuple[str, str, str]:
         if status == 'pending': return 'tips_and_updates', 'text-blue-300', 'Edits available'
+        if status == 'applying': return 'sync', 'text-blue-300', 'Applying edits'
         if status == 'success': return 'check_circle', 'text-green-400', 'All edits applied'
         if status == 'partial': return 'warning', 'text-amber-400', 'Some edits applied'
         if status == 'rejected': return 'cancel', 'text-red-400', 'Edits rejected'
         return 'cancel', 'text-red-400', 'Edits not applied'
 
-    def locate_entry(self, entry_id: str) -> ExchangeEntry | CouncilEntry | None:
-        return next((e for e in self.conversation.entries if e.id == entry_id), None)
+    def locate_entry(self, entry_id: str) -> ExchangeEntry | CouncilEntry | None: return self.conversation.entry(entry_id)
 
     def locate_assistant(self, assistant_id: str) -> tuple[ExchangeEntry | CouncilEntry | None, AssistantTurn | None, str | None, bool]:
-        for e in self.conversation.entries:
-            if isinstance(e, ExchangeEntry) and e.assistant.id == assistant_id: return e, e.assistant, self.exchange_assistant_token(e), False
-            if isinstance(e, CouncilEntry):
-                for m in e.members:
-                    if m.id == assistant_id: return e, m, self.council_member_token(e, m), True
-                if e.synthesis and e.synthesis.id == assistant_id: return e, e.synthesis, self.council_synthesis_token(e), False
-        return None, None, None, False
-
-    def valid_editable_assistant_ids(self) -> set[str]:
-        out = set()
-        for e in self.conversation.entries:
-            if isinstance(e, ExchangeEntry): out.add(e.assistant.id)
-            elif e.synthesis: out.add(e.synthesis.id)
-        return out
+        e, a = self.conversation.turn(assistant_id)
+        if a is None: return None, None, None, False
+        if isinstance(e, ExchangeEntry): return e, a, self.exchange_assistant_token(e), False
+        return (e, a, self.council_synthesis_token(e), False) if e.synthesis is a else (e, a, self.council_member_token(e, a), True)
 
     def prune_state(self):
-        valid = self.valid_editable_assistant_ids()
-        self.conversation.edit_rounds = {k: v for k, v in (self.conversation.edit_rounds or {}).items() if k in valid}
-        if not isinstance(self.conversation.pending_edit, PendingEdit) or self.conversation.pending_edit.assistant_id not in valid or not self.conversation.pending_edit.text.strip(): self.conversation.pending_edit = None
+        editable = self.conversation.editable
+        self.conversation.edit_rounds = {k: v for k, v in (self.conversation.edit_rounds or {}).items() if editable(k)}
+        if not isinstance(self.conversation.pending_edit, PendingEdit) or not editable(self.conversation.pending_edit.assistant_id) or not self.conversation.pending_edit.text.strip(): self.conversation.pending_edit = None
+
+    def persist(self, e: ExchangeEntry | CouncilEntry | None):
+        if e is not None: STORE.put_entry(self.conversation, e)
+
+    def persist_edits(self, assistant_id: str | None = None): STORE.put_edits(self.conversation, assistant_id)
+
+    async def load_older(self, everything: bool = False):
+        s = self.conversation
+        while s.offset and s is self.conversation:
+            offset = s.offset
+            entries, rounds = await STORE.page(s, offset if everything else STORE_PAGE)
+            if s is not self.conversation: return
+            if entries and s.offset == offset:  # otherwise a concurrent load prepended these already
+                s.prepend(entries)
+                s.edit_rounds = {**rounds, **s.edit_rounds}
+                self.view.sync_history(scroll=False)
+            if not everything: return
+
+    async def open_conversation(self, conversation_id: str):
+        if conversation_id == self.conversation.id: return
+        busy = lambda: self.phase() in {Phase.STREAMING, Phase.COUNCIL_STREAMING, Phase.COUNCIL_SYNTHESIZING}
+        if busy():
+            ui.notify('Finish the current response first', type='warning')
+            return
+        s = await STORE.load(conversation_id)
+        if busy() or conversation_id == self.conversation.id: return
+        if not s:
+            ui.notify('Conversation not found', type='warning')
+            return
+        try: self.take(s)
+        except RuntimeError as e:
+            ui.notify(str(e), type='warning')
+            return
+        self.page.last_edit_status = None
+        self.normalize_state()
+        self.view.render_history()
+        await self.view.refresh_conversations()
 
     def settle_assistant(self, a: AssistantTurn):
+        # A turn still streaming in another client of this tab (a reload) keeps what its run has received so far.
         if a.finalized: return
-        raw = (a.raw_text or '').rstrip()
+        raw, a.live = (a.raw_text or str(a.live or '')).rstrip(), None
         a.has_answer = a.has_answer or bool(raw)
         a.raw_text = raw or 'Response stopped.'
         a.display_text = (a.display_text or '').rstrip() or (self.chat.render_for_display(a.raw_text, a.ctx_files) if a.has_answer else a.raw_text)
@@ -472,17 +863,22 @@ class ChatPageController:
 
     def reconcile_entries(self):
         for e in self.conversation.entries:
-            if isinstance(e, ExchangeEntry):
-                self.settle_assistant(e.assistant)
-                continue
-            for m in e.members: self.settle_assistant(m)
-            if e.synthesis: self.settle_assistant(e.synthesis)
-            if e.status in {'streaming_members', 'streaming_synthesis'}: e.status = 'interrupted'
+            streaming = isinstance(e, CouncilEntry) and e.status in {'streaming_members', 'streaming_synthesis'}
+            if not streaming and all(a.finalized for a in self.conversation.turns(e)): continue
+            for a in self.conversation.turns(e): self.settle_assistant(a)
+            if streaming: e.status = 'interrupted'
+            self.persist(e)
         self.prune_state()
 
     def run_for_assistant(self, assistant_id: str) -> LiveRun | None:
         return self.runs.exchange_run if self.runs.exchange_run and self.runs.exchange_run.target_id == assistant_id else self.runs.member_runs.get(assistant_id) or (self.runs.synthesis_run if self.runs.synthesis_run and self.runs.synthesis_run.target_id == assistant_id else None)
 
+    def live_runs(self) -> list[LiveRun]: return [x for x in [self.runs.exchange_run, self.runs.synthesis_run, *self.runs.member_runs.values()] if x]
+
+    def mark_dirty(self, r: LiveRun):
+        r.dirty = True
+        FLUSHER.mark(self)
+
     def is_live(self, r: LiveRun) -> bool:
         return self.runs.exchange_run is r or self.runs.member_runs.get(r.target_id) is r or self.runs.synthesis_run is r
 
@@ -493,10 +889,12 @@ class ChatPageController:
 
     def start_run(self, kind: Literal['exchange', 'council_member', 'council_synthesis'], entry_id: str, assistant: AssistantTurn, stream: Any):
         r = LiveRun(new_id(), kind, entry_id, assistant.id, started_at=time.monotonic())
+        assistant.live = r.raw_buffer
         if kind == 'exchange': self.runs.exchange_run = r
         elif kind == 'council_synthesis': self.runs.synthesis_run = r
         else: self.runs.member_runs[assistant.id] = r
         r.task = asyncio.create_task(self.run_stream(r, stream))
+        self.mark_dirty(r)
         return r
 
     async def run_stream(self, r: LiveRun, stream: Any):
@@ -505,20 +903,33 @@ class ChatPageController:
             async for chunk in stream:
                 if not self.is_live(r): return
                 if isinstance(chunk, ReasoningEvent):
-                    if not r.has_answer and chunk.text: r.reasoning, r.reasoning_delta = r.reasoning + chunk.text, r.reasoning_delta + chunk.text
+                    if not r.has_answer and chunk.text: r.reasoning.append(chunk.text), r.reasoning_delta.append(chunk.text), self.mark_dirty(r)
                     continue
                 if not isinstance(chunk, str) or not chunk: continue
                 if not r.has_answer:
                     _, a, _, _ = self.locate_assistant(r.target_id)
                     r.has_answer, r.renderer, r.reset_display = True, self.chat.new_display_renderer(a.ctx_files if a else []), True
-                r.raw_buffer += chunk
-                if r.renderer and (delta := r.renderer.feed(chunk)): r.display_delta += delta
+                    if r.kind != 'council_member': r.validator = self.chat.new_edit_validator(a.ctx_files if a else [])
+                r.raw_buffer.append(chunk)
+                if r.renderer and (delta := r.renderer.feed(chunk)): r.display_delta.append(delta)
+                self.mark_dirty(r)
+                if r.validator and (blocks := r.validator.feed(chunk)): self.check_edits(r, blocks)
+            if r.validator and (blocks := r.validator.finish()) and self.is_live(r): self.check_edits(r, blocks)
+            if r.checks: await r.checks
         except asyncio.CancelledError:
             return
         except Exception as e:
             err = str(e)
         finally:
-            if self.is_live(r): r.error, r.done = err, True
+            if r.checks and not r.checks.done(): r.checks.cancel()
+            if self.is_live(r): r.error, r.done = err, True; self.mark_dirty(r)
+
+    def check_edits(self, r: LiveRun, blocks: list[Any]):
+        # Anchors are resolved off the stream: the checks run one after another in a thread while chunks keep flowing.
+        async def check(before: asyncio.Task | None):
+            if before: await before
+            await asyncio.to_thread(r.validator.check, blocks)
+        r.checks = asyncio.create_task(check(r.checks))
 
     def finalize_run(self, r: LiveRun):
         if not self.is_live(r): return
@@ -527,20 +938,22 @@ class ChatPageController:
             self.drop_run(r)
             return
         if r.has_answer and r.renderer and hasattr(r.renderer, 'finish') and (delta := r.renderer.finish() or ''):
-            a.display_text += delta
+            r.display.append(delta)
             if token in self.refs.content_ids: self.view.append_markdown_buffered(self.refs.content_ids[token], delta)
         if r.has_answer and token in self.refs.content_ids: self.view.finish_markdown_buffered(self.refs.content_ids[token])
-        raw = (r.raw_buffer or a.raw_text or '').rstrip() or 'Response stopped.'
-        display = (a.display_text or '').rstrip() or (self.chat.render_for_display(raw, a.ctx_files) if r.has_answer else raw)
+        raw = (str(r.raw_buffer) or a.raw_text or '').rstrip() or 'Response stopped.'
+        display = (str(r.display) or a.display_text or '').rstrip() or (self.chat.render_for_display(raw, a.ctx_files) if r.has_answer else raw)
         a.raw_text, a.display_text, a.has_answer = raw, display, r.has_answer or bool((a.raw_text or '').strip())
-        a.elapsed, a.finalized, a.interrupted, a.error = self.run_elapsed(r), True, r.interrupted, r.error
+        a.elapsed, a.finalized, a.interrupted, a.error, a.live = self.run_elapsed(r), True, r.interrupted, r.error, None
+        if isinstance(e, CouncilEntry) and not is_member: e.status = 'completed' if not (r.error or r.interrupted) else 'interrupted'
+        self.persist(e)
         if token in self.refs.content_ids and not r.has_answer: self.view.set_markdown(self.refs.content_ids[token], display, True)
         if a.id in self.refs.timer_labels: self.refs.timer_labels[a.id].text = self.timer_text(a.elapsed)
         self.view.set_assistant_status(a.id, None)
         self.drop_run(r)
         if r.error: ui.notify(f'{a.label or a.model}: {r.error}', type='negative')
         if isinstance(e, ExchangeEntry):
-            if a.has_answer and not r.error and not r.interrupted and self.chat.parse_edit_markdown(raw): self.set_pending_edits(raw, a.id)
+            if a.has_answer and not r.error and not r.interrupted and (directives := self.chat.parse_edit_markdown(raw)): self.set_pending_edits(raw, a.id, directives, r.validator)
             self.view.update_controls()
             return
         if not isinstance(e, CouncilEntry): return
@@ -548,8 +961,7 @@ class ChatPageController:
             if e.status == 'streaming_members' and not self.runs.member_runs and all(m.finalized for m in e.members): self.start_council_synthesis(e)
             self.view.update_controls()
             return
-        e.status = 'completed' if not (r.error or r.interrupted) else 'interrupted'
-        if a.has_answer and not r.error and not r.interrupted and self.chat.parse_edit_markdown(raw): self.set_pending_edits(raw, a.id)
+        if a.has_answer and not r.error and not r.interrupted and (directives := self.chat.parse_edit_markdown(raw)): self.set_pending_edits(raw, a.id, directives, r.validator)
         self.view.update_controls()
 
     def build_council_prompt(self, c: CouncilEntry) -> str:
@@ -582,20 +994,32 @@ class ChatPageController:
             'rejected': 'I rejected your latest round of edits above.',
         }.get(status)
 
-    def set_pending_edits(self, text: str, assistant_id: str):
-        text, targets = (text or '').rstrip(), self.edit_targets(text) or ['edits']
-        self.conversation.pending_edit = PendingEdit(assistant_id, text, targets)
+    def set_pending_edits(self, text: str, assistant_id: str, directives: list[EditDirective], validator: Any = None):
+        text, targets = (text or '').rstrip(), self.edit_targets(directives) or ['edits']
+        self.conversation.pending_edit = PendingEdit(assistant_id, text, targets, *((validator.resolved, validator.total) if validator else (0, 0)))
         self.conversation.edit_rounds[assistant_id] = EditRound(status='pending', items=[EditItem(t, 'pending') for t in targets], text=text)
         self.page.last_edit_status = 'pending'
+        self.persist_edits(assistant_id)
         self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
         self.view.update_controls()
+        asyncio.create_task(self.plan_pending_edits(assistant_id, directives))
+
+    async def plan_pending_edits(self, assistant_id: str, directives: list[EditDirective]):
+        ctx = (self.locate_assistant(assistant_id)[1] or AssistantTurn('', '', '')).ctx_files
+        try: plan = await asyncio.to_thread(self.chat.plan_edits, directives, ctx)
+        except Exception: return
+        p = self.conversation.pending_edit
+        if not p or p.assistant_id != assistant_id or p.plan: return
+        p.plan, p.resolved, p.checked = plan, plan.resolved, plan.checked
+        self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
 
     def reopen_edit_round(self, assistant_id: str) -> bool:
         r, text = self.conversation.edit_rounds.get(assistant_id), (self.conversation.edit_rounds.get(assistant_id).text if self.conversation.edit_rounds.get(assistant_id) else '').rstrip()
         if not r or r.status != 'rejected' or not text or self.conversation.pending_edit: return False
-        targets = [it.label.strip() for it in r.items if it.label.strip()] or self.edit_targets(text) or ['edits']
+        targets = [it.label.strip() for it in r.items if it.label.strip()] or self.edit_targets(self.chat.parse_edit_markdown(text)) or ['edits']
         self.conversation.pending_edit, self.page.last_edit_status = PendingEdit(assistant_id, text, targets), None
         self.conversation.edit_rounds[assistant_id] = EditRound(status='pending', items=[EditItem(t, 'pending') for t in targets], text=text)
+        self.persist_edits(assistant_id)
         self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
         self.view.update_controls()
         return True
@@ -610,6 +1034,7 @@ class ChatPageController:
             self.conversation.edit_rounds.pop(p.assistant_id, None)
         self.view.render_edit_round_slot(self.refs.edit_slots.get(p.assistant_id), p.assistant_id)
         self.conversation.pending_edit = None
+        self.persist_edits(p.assistant_id)
         self.view.update_controls()
 
     def clear_edit_round_state(self, before_send: bool = False) -> str | None:
@@ -621,12 +1046,26 @@ class ChatPageController:
     async def apply_pending_edits(self, assistant_id: str):
         p = self.conversation.pending_edit
         if not p or p.assistant_id != assistant_id or not p.text.strip(): return
-        text, targets = p.text.rstrip(), p.targets[:] or self.edit_targets(p.text) or ['edits']
+        text, targets, plan = p.text.rstrip(), p.targets[:] or ['edits'], p.plan
         self.conversation.pending_edit = None
+        self.conversation.edit_rounds[assistant_id] = EditRound(status='applying', items=[EditItem(t, 'pending') for t in targets], text=text)
+        self.persist_edits(assistant_id)
+        self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
+        self.view.update_controls()
+
+        def on_progress(ev: EditEvent):
+            r = self.conversation.edit_rounds.get(assistant_id)
+            if not r or r.status != 'applying': return
+            for it in r.items:
+                if (x := it.label.strip().replace('\\', '/')) == ev.path or (ev.path or '').endswith('/' + x): it.status = 'staged'
+            self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
+
         try:
-            events = self.chat.apply_markdown_edits(text, assistant_id, (self.locate_assistant(assistant_id)[1] or AssistantTurn('', '', '')).ctx_files) or []
+            plan = plan or await asyncio.to_thread(self.chat.plan_edits, self.chat.parse_edit_markdown(text), (self.locate_assistant(assistant_id)[1] or AssistantTurn('', '', '')).ctx_files)
+            events = await self.chat.apply_edit_plan(plan, assistant_id, on_progress) or []
         except Exception as e:
             self.conversation.edit_rounds[assistant_id], self.page.last_edit_status = EditRound(status='error', items=[EditItem(t, 'error') for t in targets], text=text), 'failed'
+            self.persist_edits(assistant_id)
             self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
             ui.notify(f'Edit error: {e}', type='negative')
             self.view.update_controls()
@@ -639,6 +1078,7 @@ class ChatPageController:
         n_ok, n_partial, n_err = sum(x.status == 'success' for x in items), sum(x.status == 'partial' for x in items), sum(x.status == 'error' for x in items)
         status = 'error' if n_err and not (n_ok or n_partial) else 'partial' if n_partial or (n_ok and n_err) else 'success'
         self.conversation.edit_rounds[assistant_id], self.page.last_edit_status = EditRound(status=status, items=items, text=text), ('applied' if status == 'success' else 'partial' if status == 'partial' else 'failed')
+        self.persist_edits(assistant_id)
         self.view.render_edit_round_slot(self.refs.edit_slots.get(assistant_id), assistant_id)
         self.view.update_controls()
         if x := self.chat.consume_user_input_prefill():
@@ -718,7 +1158,7 @@ class ChatPageController:
         if callable(prevent):
             result = prevent()
             if asyncio.iscoroutine(result): await result
-        self.send()
+        await self.send()
 
     def remove_file(self, path: str):
         with contextlib.suppress(ValueError): self.page.file_attachments.remove(path)
@@ -733,11 +1173,12 @@ class ChatPageController:
     def start_exchange(self, msg: str, note: str | None, atts: list[Attachment]):
         display, history, force_edit = (f'{note}\n\n{msg}' if note else msg), (f'{(f"{note}\n\n{msg}" if note else msg)}\n\n{EXTRACT_ADD_ON}' if self.page.mode == 'extract' else (f'{note}\n\n{msg}' if note else msg)), self.page.mode == 'chat+edit'
         e = ExchangeEntry(new_id(), UserTurn(new_id(), display, msg, history, [Attachment(a.kind, a.path, a.url, a.content) for a in atts], force_edit), AssistantTurn(new_id(), self.page.model, self.page.model, ctx_files=self.file_ctx(atts)))
-        self.conversation.entries.append(e)
+        self.conversation.append(e)
+        self.persist(e)
         self.page.file_attachments, self.page.url_attachments = [], []
         self.set_draft_text('')
         self.start_run('exchange', e.id, e.assistant, self.chat.stream(self.prompts.normal_request_messages(self.conversation, e), self.page.model, self.page.reasoning))
-        self.view.render_history()
+        self.view.sync_history()
         self.view.render_pending_attachments()
 
     def start_council(self, msg: str, note: str | None, atts: list[Attachment]):
@@ -745,19 +1186,22 @@ class ChatPageController:
         member_prompt = f'{display}\n\n{EXTRACT_ADD_ON}' if self.page.mode == 'extract' else display
         members = [AssistantTurn(new_id(), model, model if n == 1 else f'{model} #{i}', ctx_files=self.file_ctx(atts)) for model in MODELS for n in [counts.get(model, 0)] for i in range(1, n + 1)]
         c = CouncilEntry(new_id(), UserTurn(new_id(), display, msg, display, [Attachment(a.kind, a.path, a.url, a.content) for a in atts], force_edit), member_prompt, members=members, status='streaming_members')
-        self.conversation.entries.append(c)
+        self.conversation.append(c)
+        self.persist(c)
         self.page.file_attachments, self.page.url_attachments, self.page.council_counts = [], [], {}
         for m in c.members: self.start_run('council_member', c.id, m, self.chat.stream(self.prompts.member_request_messages(self.conversation, c), m.model, self.page.reasoning))
         self.set_draft_text('')
         self.view.refresh_model_picker()
-        self.view.render_history()
+        self.view.sync_history()
         self.view.render_pending_attachments()
 
     def start_council_synthesis(self, c: CouncilEntry):
         if c.synthesis or c.status != 'streaming_members': return
         c.synthesis, c.status = AssistantTurn(new_id(), self.page.model, f'Synthesis · {self.page.model}', ctx_files=self.file_ctx(c.query.attachments)), 'streaming_synthesis'
+        self.conversation.add_turn(c, c.synthesis)
+        self.persist(c)
         self.start_run('council_synthesis', c.id, c.synthesis, self.chat.stream(self.prompts.synthesis_request_messages(self.conversation, c, self.build_council_prompt(c)), self.page.model, self.page.reasoning))
-        self.view.render_history()
+        self.view.sync_history()
 
     def cancel_run(self, r: LiveRun):
         if isinstance(r.task, asyncio.Task) and not r.task.done(): r.task.cancel()
@@ -773,9 +1217,12 @@ class ChatPageController:
         e = self.locate_entry(entry_id) if entry_id else None
         return e if isinstance(e, CouncilEntry) else None
 
-    def send(self):
-        msg = (self.refs.input_field.value or '').strip()
-        if self.phase() in {Phase.STREAMING, Phase.COUNCIL_STREAMING, Phase.COUNCIL_SYNTHESIZING} or not msg: return
+    async def send(self):
+        busy = lambda: self.phase() in {Phase.STREAMING, Phase.COUNCIL_STREAMING, Phase.COUNCIL_SYNTHESIZING} or not (self.refs.input_field.value or '').strip()
+        if busy(): return
+        if self.conversation.offset: await self.load_older(everything=True)  # the model sees the whole conversation
+        if busy() or self.conversation.offset: return
+        msg = self.refs.input_field.value.strip()
         note, atts = self.clear_edit_round_state(before_send=True), self.current_attachments()
         if self.council_total() > 0:
             self.start_council(msg, note, atts)
@@ -812,7 +1259,8 @@ class ChatPageController:
             return
         ui.notify('No active response to stop', type='warning')
 
-    def undo(self):
+    async def undo(self):
+        if not self.conversation.entries and self.conversation.offset: await self.load_older()
         if not self.conversation.entries:
             ui.notify('No messages to undo', type='warning')
             return
@@ -821,53 +1269,58 @@ class ChatPageController:
         self.cancel_entry_runs(e.id)
         try:
             if isinstance(e, ExchangeEntry):
-                if not self.chat.rollback_edits_for_assistant(e.assistant.id): raise RuntimeError(f'Failed to rollback edits for assistant {e.assistant.id}')
+                skipped = await self.chat.rollback_edits_for_assistant(e.assistant.id)
                 restore, atts = e.user.restore_text, e.user.attachments
             else:
-                if e.synthesis and not self.chat.rollback_edits_for_assistant(e.synthesis.id): raise RuntimeError(f'Failed to rollback edits for assistant {e.synthesis.id}')
+                skipped = await self.chat.rollback_edits_for_assistant(e.synthesis.id) if e.synthesis else []
                 restore, atts = e.query.restore_text, e.query.attachments
         except Exception as x:
             ui.notify(f'Undo failed: {x}', type='negative')
             return
-        self.conversation.entries.pop()
+        if not self.conversation.entries or self.conversation.entries[-1] is not e: return
+        self.conversation.pop()
+        STORE.drop_entries(self.conversation, self.conversation.offset + len(self.conversation.entries), [a.id for a in self.conversation.turns(e)])
         self.prune_state()
         self.restore_attachments(atts)
         self.set_draft_text(restore)
         if (aid := next((x for x in [y.assistant.id for y in reversed(self.conversation.entries) if isinstance(y, ExchangeEntry)] + [y.synthesis.id for y in reversed(self.conversation.entries) if isinstance(y, CouncilEntry) and y.synthesis] if x), None)): self.reopen_edit_round(aid)
-        self.view.render_history()
+        self.view.sync_history()
         self.view.render_pending_attachments()
         self.view.focus_input()
+        if skipped: ui.notify(f'Left as is, changed since the edit: {", ".join(skipped)}', type='warning')
 
     def clear_chat(self):
-        self.clear_edit_round_state()
+        # Starts a new conversation; the old one stays in the store, pending edits included, and can be reopened.
+        self.page.last_edit_status = None
         self.cancel_entry_runs(self.runs.exchange_run.entry_id) if self.runs.exchange_run else None
         self.cancel_entry_runs(self.runs.synthesis_run.entry_id) if self.runs.synthesis_run else None
         for r in list(self.runs.member_runs.values()): self.cancel_run(r)
-        self.conversation.entries, self.conversation.pending_edit, self.conversation.edit_rounds = [], None, {}
+        self.take(ConversationState())
         self.page.file_attachments, self.page.url_attachments, self.page.council_counts, self.page.search_results, self.page.search_idx = [], [], {}, [], -1
         self.set_draft_text('')
         self.view.clear_search_results()
-        self.view.render_history()
+        self.view.sync_history()
         self.view.render_pending_attachments()
         self.view.refresh_model_picker()
         ui.notify('Chat cleared', type='positive')
 
     def flush_updates(self):
-        for r in [x for x in [self.runs.exchange_run, self.runs.synthesis_run, *self.runs.member_runs.values()] if x]:
+        for r in self.live_runs():
+            if not r.dirty: continue
+            r.dirty = False
             _, a, token, _ = self.locate_assistant(r.target_id)
             self.view.set_assistant_status(r.target_id, 'answering' if r.has_answer else 'thinking')
             if token in self.refs.content_ids:
                 content_id = self.refs.content_ids[token]
                 if r.reset_display:
                     self.view.set_markdown(content_id, '', True)
-                    a and setattr(a, 'display_text', '')
+                    r.display.clear()
                     r.reset_display = False
                 if not r.has_answer and r.reasoning_delta:
-                    delta, r.reasoning_delta = r.reasoning_delta, ''
-                    self.view.append_markdown(content_id, delta)
+                    self.view.append_markdown(content_id, r.reasoning_delta.take())
                 if r.has_answer and r.display_delta:
-                    delta, r.display_delta = r.display_delta, ''
-                    if a: a.display_text, a.raw_text = a.display_text + delta, r.raw_buffer
+                    delta = r.display_delta.take()
+                    r.display.append(delta)
                     self.view.append_markdown_buffered(content_id, delta)
             if r.done: self.finalize_run(r)
 
@@ -883,8 +1336,9 @@ class ChatPageController:
         self.view.render_pending_attachments()
         if self.page.search_results: self.view.render_search_results()
         self.view.update_controls()
-        ui.timer(1 / 60, self.flush_updates)
-        ui.timer(1.0, self.tick_timer)
+        ui.on('chat7_slots', lambda e: self.view.sync_slots(e.args or {}))
+        ui.on('chat7_markdown_miss', lambda e: self.view.markdown_miss(e.args or {}))
+        self.view.client.on_delete(self.close)
         if not (self.refs.input_field.value or '').strip() and (p := self.chat.consume_user_input_prefill()): self.set_draft_text(p)
 
 
@@ -895,33 +1349,114 @@ async def main_page():
     ChatPageController.load(app.storage.tab).mount()
 
 class ZstdMiddleware:
-    def __init__(self, app, *, level=10, minimum_size=500):
-        self.app, self.minimum_size, self.c = app, minimum_size, zstd.ZstdCompressor(level=level)
+    """Streams zstd-compressed responses: one compressor per response, a block flushed per body chunk so streamed
+    responses keep streaming, and memory bounded by the compression window instead of the response size.
+    With a shared dictionary (`codec`), clients that advertise it get `dcz`, which pays off down to tiny bodies."""
+    def __init__(self, app, *, level=10, minimum_size=500, dict_minimum_size=64, codec: ZstdCodec = ZSTD):
+        self.app, self.level, self.minimum_size, self.dict_minimum_size = app, level, minimum_size, dict_minimum_size
+        # The browser loads the dictionary as raw content, so it is used as one here too rather than by dictionary id.
+        self.dcz = codec.data and (f':{base64.b64encode(codec.sha256).decode()}:'.encode(), DCZ_MAGIC + codec.sha256, zstd.ZstdCompressionDict(codec.data, dict_type=zstd.DICT_TYPE_RAWCONTENT))
 
     async def __call__(self, scope, receive, send):
-        if scope['type'] != 'http': return await self.app(scope, receive, send)
-        if b'zstd' not in dict(scope['headers']).get(b'accept-encoding', b''): return await self.app(scope, receive, send)
-
-        start, chunks = None, []
-        async def capture(message):
-            nonlocal start
-            if message['type'] == 'http.response.start': start = message
-            elif message['type'] == 'http.response.body': chunks.append(message.get('body', b''))
-
-        await self.app(scope, receive, capture)
-        body = b''.join(chunks)
-        headers = MutableHeaders(raw=start['headers'])
-        if len(body) >= self.minimum_size and 'content-encoding' not in headers:
-            body = self.c.compress(body)
-            headers['Content-Encoding'] = 'zstd'
-            headers['Content-Length'] = str(len(body))
-            headers['Vary'] = 'Accept-Encoding' if 'vary' not in headers else f"{headers['vary']}, Accept-Encoding"
-        await send({**start, 'headers': headers.raw})
-        await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+        if scope['type'] != 'http' or scope.get('method') == 'HEAD': return await self.app(scope, receive, send)
+        req = dict(scope['headers'])
+        dcz = bool(self.dcz) and b'dcz' in req.get(b'accept-encoding', b'') and req.get(b'available-dictionary', b'').strip() == self.dcz[0]
+        if not dcz and b'zstd' not in req.get(b'accept-encoding', b''): return await self.app(scope, receive, send)
+
+        start, cobj, prefix = None, None, b''
+        async def compress(message):
+            nonlocal start, cobj, prefix
+            if message['type'] == 'http.response.start':
+                start = message  # held back until the first body chunk shows whether compressing is worth it
+                return
+            if message['type'] != 'http.response.body': return await send(message)
+            body, more = message.get('body', b''), message.get('more_body', False)
+            if start:
+                headers = MutableHeaders(raw=start['headers'])
+                ctype = headers.get('content-type', '')
+                if not ('content-encoding' in headers or start['status'] in {204, 304} or (ctype.startswith(INCOMPRESSIBLE_TYPES) and '+xml' not in ctype) or (not more and len(body) < (self.dict_minimum_size if dcz else self.minimum_size))):
+                    cobj = zstd.ZstdCompressor(level=self.level, dict_data=self.dcz[2] if dcz else None).compressobj()
+                    prefix = self.dcz[1] if dcz else b''
+                    vary = [v for v in ('Accept-Encoding', 'Available-Dictionary')[:2 if self.dcz else 1] if v.lower() not in headers.get('vary', '').lower()]
+                    del headers['Content-Length']
+                    headers['Content-Encoding'] = 'dcz' if dcz else 'zstd'
+                    if vary: headers['Vary'] = ', '.join([headers['vary'], *vary] if 'vary' in headers else vary)
+                    if (etag := headers.get('etag')) and not etag.startswith('W/'): headers['ETag'] = f'W/{etag}'  # the encoded body is not byte-identical
+                await send({**start, 'headers': headers.raw})
+                start = None
+            if not cobj: return await send(message)
+            body, prefix = prefix + cobj.compress(body) + cobj.flush(zstd.COMPRESSOBJ_FLUSH_BLOCK if more else zstd.COMPRESSOBJ_FLUSH_FINISH), b''
+            if body or not more: await send({'type': 'http.response.body', 'body': body, 'more_body': more})
+
+        await self.app(scope, receive, compress)
+
+class StickyProxy:
+    """Front for `--workers`: terminates TLS and pins each browser to one worker process by a `chat7_worker` cookie, so a tab's
+    page load, websocket and `/chat7-msg` fetches all reach the process holding its state while clients behind one address (NAT,
+    a corporate proxy) still spread over the workers. Conversations, edit locks and undo journals are shared through the SQLite
+    store and flocks. Only a connection's first request is routed: later keep-alive requests carry the same cookie anyway."""
+    COOKIE = re.compile(rb'(?im)^cookie:.*?\bchat7_worker=(\d+)')
+
+    def __init__(self, host: str, port: int, ports: list[int], tls: ssl.SSLContext | None = None):
+        self.host, self.port, self.ports, self.tls, self.turn = host, port, ports, tls, 0
+
+    def route(self, head: bytes) -> tuple[list[int], bool]:
+        if (m := self.COOKIE.search(head)) and int(m[1]) < len(self.ports): i, new = int(m[1]), False
+        else: i, new, self.turn = self.turn % len(self.ports), True, self.turn + 1  # a new browser: deal it the next worker
+        return self.ports[i:] + self.ports[:i], new  # the pinned worker, then the others in case it is down
+
+    @staticmethod
+    async def pipe(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+        with contextlib.suppress(ConnectionError, OSError):
+            while data := await r.read(1 << 16):
+                w.write(data)
+                await w.drain()
+            if w.can_write_eof(): w.write_eof()
+
+    async def handle(self, cr: asyncio.StreamReader, cw: asyncio.StreamWriter):
+        with contextlib.suppress(ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            head = await cr.readuntil(b'\r\n\r\n')
+            ports, new = self.route(head)
+            for port in ports:
+                try: ur, uw = await asyncio.open_connection('127.0.0.1', port)
+                except OSError: continue
+                uw.write(head)
+                up = asyncio.create_task(self.pipe(cr, uw))
+                try:
+                    if new or port != ports[0]:  # pin the browser to whichever worker answered, in case its own was down
+                        reply = await ur.readuntil(b'\r\n\r\n')
+                        cw.write(reply[:-2] + b'Set-Cookie: chat7_worker=%d; Path=/; Secure; HttpOnly; SameSite=Lax\r\n\r\n' % self.ports.index(port))
+                    await self.pipe(ur, cw)  # the worker closing its side ends the exchange: TLS cannot pass a half-close on
+                finally: up.cancel(); uw.close()
+                break
+        cw.close()
+
+    async def serve(self):
+        async with await asyncio.start_server(self.handle, self.host, self.port, ssl=self.tls) as server: await server.serve_forever()
+
+
+def run_workers(port: int, workers: int):
+    ports = [port + 1 + i for i in range(workers)]
+    procs = [subprocess.Popen([sys.executable, __file__, '--worker', '--port', str(p)]) for p in ports]
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # stop the workers on SIGTERM as on Ctrl-C
+    tls = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    tls.load_cert_chain('cert.pem', 'key.pem')
+    try:
+        with contextlib.suppress(KeyboardInterrupt): asyncio.run(StickyProxy('0.0.0.0', port, ports, tls).serve())
+    finally:
+        for p in procs: p.terminate()
+        for p in procs: p.wait()
 
 
 if __name__ in {'__main__', '__mp_main__'}:
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=1, help='run this many worker processes behind a proxy on --port that terminates TLS and pins each browser to a worker by cookie')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--vendor', action='store_true', help='download the pinned front-end libraries into static/vendor and exit')
+    parser.add_argument('--train-zstd-dict', nargs='+', metavar='PATH', help=f'train the shared zstd dictionary ({ZSTD_DICT_PATH.name}) from these files or directories and exit')
     args = parser.parse_args()
-    ui.run(title='AI Chat', port=args.port, host='0.0.0.0', dark=True, show=False, reconnect_timeout=300, ssl_certfile='cert.pem', ssl_keyfile='key.pem', gzip_middleware_factory=lambda a: ZstdMiddleware(a, level=9, minimum_size=300))
\ No newline at end of file
+    if args.vendor: raise SystemExit(vendor_assets())
+    if args.train_zstd_dict: raise SystemExit(train_zstd_dict(args.train_zstd_dict))
+    if args.workers > 1 and not args.worker: raise SystemExit(run_workers(args.port, args.workers))
+    ui.run(title='AI Chat', port=args.port, host='127.0.0.1' if args.worker else '0.0.0.0', reload=not args.worker, dark=True, show=False, reconnect_timeout=300, ssl_certfile=None if args.worker else 'cert.pem', ssl_keyfile=None if args.worker else 'key.pem', gzip_middleware_factory=lambda a: ZstdMiddleware(a, level=9, minimum_size=300))
\ No newline at end of file
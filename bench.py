@@ -0,0 +1,264 @@
+"""Throughput benchmarks for the streaming hot paths.
+
+    python bench.py display [--size 256]
+    python bench.py buffer [--tokens 100000]
+"""
+import argparse
+import random
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from chat_utils3 import DisplayCommandState, DisplayRenderer, EditService, ReplaceBlock, TextBuffer
+
+
+class LegacyDisplayRenderer:
+    """Renderer as it was before the single-pass rewrite: one growing tail string and a regex cascade per line."""
+
+    def __init__(self, service: EditService, ctx_files: list[str]):
+        self.service = service
+        self.ctx_files = [p for p in ctx_files if p]
+        self.current_file = ''
+        self.cmd: DisplayCommandState | None = None
+        self.in_fence = False
+        self.tail = ''
+        self.tail_emitted = 0
+
+    @staticmethod
+    def _candidate_mode(s: str) -> str:
+        t = s.lstrip()
+        return 'unknown' if t == '' else 'header' if t.startswith('#') else 'fence' if t.startswith('```') else 'ordinary'
+
+    def _streaming_command_fence(self) -> bool:
+        return self.cmd is not None and self.cmd.phase == 'stream_new'
+
+    def _append_partial(self, frag: str) -> str:
+        if not frag: return ''
+        self.tail += frag
+        if self.in_fence or self._streaming_command_fence() or (self.cmd is None and self._candidate_mode(self.tail) == 'ordinary'):
+            out = self.tail[self.tail_emitted:]
+            self.tail_emitted = len(self.tail)
+            return out
+        return ''
+
+    @staticmethod
+    def _join_raw(lines: list[str], final_newline: bool) -> str:
+        return ('' if not lines else '\n'.join(lines)) + ('\n' if lines and final_newline else '')
+
+    def _flush_raw(self, final_newline: bool) -> str:
+        out, self.cmd = self._join_raw(self.cmd.raw if self.cmd else [], final_newline), None
+        return out
+
+    def _render(self) -> str:
+        if not self.cmd: return ''
+        c = self.cmd
+        blk = ReplaceBlock(op=c.op, start1=c.start1, start2=c.start2, end=c.end, anchor=c.anchor)
+        if not (text := self.service.render_edit_header(c.filename, blk, self.ctx_files)): return self._flush_raw(True)
+        c.raw, c.phase = [], 'new_fence'
+        return text + '\n'
+
+    def _begin_command(self, line: str) -> str:
+        if not self.current_file or not (m := self.service._COMMAND_HDR_RE.match(line)): return line + '\n'
+        op = self.service._OPS[m.group(1).strip().lower()]
+        if op == 'write': return line + '\n'
+        self.cmd = DisplayCommandState(op=op, filename=self.current_file, phase='start1' if op == 'replace' else 'anchor', raw=[line])
+        return ''
+
+    def _finish_command_line(self, line: str, emitted: int = 0) -> str:
+        if not self.cmd: return line + '\n'
+        c = self.cmd
+        if c.phase == 'stream_new':
+            if self.service._FENCE_CLOSE_RE.match(line): self.cmd = None
+            return line[emitted:] + '\n'
+        c.raw.append(line)
+        if c.op == 'replace':
+            if c.phase == 'start1':
+                if line.strip() == '': return ''
+                if not (m := self.service._KEY_RE.match(line)): return self._flush_raw(True)
+                if m.group(1) == 'Anchor' and m.group(2) != '':
+                    c.anchor = m.group(2)
+                    return self._render()
+                if m.group(1) != 'StartAnchor1': return self._flush_raw(True)
+                c.start1, c.phase = m.group(2), 'start2'
+                return ''
+            if c.phase == 'start2':
+                if line.strip() == '': return ''
+                if not (m := self.service._KEY_RE.match(line)) or m.group(1) != 'StartAnchor2': return self._flush_raw(True)
+                c.start2, c.phase = m.group(2), 'end'
+                return ''
+            if c.phase == 'end':
+                if line.strip() == '': return ''
+                if not (m := self.service._KEY_RE.match(line)) or m.group(1) != 'EndAnchor': return self._flush_raw(True)
+                c.end = m.group(2)
+                return self._render()
+        else:
+            if c.phase == 'anchor':
+                if line.strip() == '': return ''
+                if not (m := self.service._KEY_RE.match(line)) or m.group(1) != 'Anchor' or m.group(2) == '': return self._flush_raw(True)
+                c.anchor = m.group(2)
+                return self._render()
+        if c.phase == 'new_fence':
+            if line.strip() == '': return ''
+            if self.service._FENCE_OPEN_RE.match(line):
+                c.raw, c.phase = [], 'stream_new'
+                return line + '\n'
+            self.cmd = None
+            return line + '\n'
+        self.cmd = None
+        return line + '\n'
+
+    def _finish_complete_line(self) -> str:
+        line, emitted = self.tail, self.tail_emitted
+        self.tail, self.tail_emitted = '', 0
+        if self.cmd: return self._finish_command_line(line, emitted)
+        if self.in_fence:
+            if self.service._FENCE_CLOSE_RE.match(line): self.in_fence = False
+            return line[emitted:] + '\n'
+        if m := self.service._EDIT_HDR_RE.match(line):
+            self.current_file = (m.group(1) or '').strip().replace('`', '')
+            return line[emitted:] + '\n'
+        if self.service._FENCE_OPEN_RE.match(line):
+            self.in_fence = True
+            return line[emitted:] + '\n'
+        return self._begin_command(line) if emitted == 0 else line[emitted:] + '\n'
+
+    def _finish_tail(self) -> str:
+        line, emitted = self.tail, self.tail_emitted
+        self.tail, self.tail_emitted = '', 0
+        if line == '': return self._flush_raw(False) if self.cmd and self.cmd.raw else ''
+        if self.cmd:
+            if self._streaming_command_fence(): return line[emitted:]
+            self.cmd.raw.append(line)
+            return self._flush_raw(False)
+        if self.in_fence: return line[emitted:]
+        if m := self.service._EDIT_HDR_RE.match(line):
+            self.current_file = (m.group(1) or '').strip().replace('`', '')
+            return line[emitted:] if emitted else line
+        return line[emitted:] if emitted else line
+
+    def feed(self, chunk: str) -> str:
+        if not chunk: return ''
+        data, out = self.service._norm_newlines(chunk), []
+        while True:
+            i = data.find('\n')
+            if i < 0:
+                if tail := self._append_partial(data): out.append(tail)
+                break
+            self.tail, data = self.tail + data[:i], data[i + 1:]
+            out.append(self._finish_complete_line())
+        return ''.join(out)
+
+    def finish(self) -> str: return self._finish_tail()
+
+
+def display_corpus(kind: str, size: int, rng: random.Random) -> str:
+    if kind == 'long-line':
+        body = ','.join(f'"k{i}":{rng.randint(0, 10 ** 6)}' for i in range(size // 12))
+        return f'Minified payload:\n\n```json\n{{{body}}}\n```\n\nA paragraph that is one very long line: ' + ' '.join('word' for _ in range(size // 10)) + '\n'
+    if kind == 'edits':
+        out = []
+        while sum(map(len, out)) < size:
+            i = rng.randint(0, 999)
+            out.append(f'### Edit data.txt\nWhy: tweak line {i}.\n#### Replace\nAnchor|line {i}\n```\nline {i} changed\n```\n\n')
+        return ''.join(out)
+    out = []
+    while sum(map(len, out)) < size:
+        out.append(rng.choice([
+            'Some prose with `inline code`, **bold** text and a [link](https://example.com).\n\n',
+            '- a list item\n- another item with more words in it\n\n',
+            '```python\ndef f(x):\n    return x * 2\n\nprint(f(21))\n```\n\n',
+            '## A heading\n\n',
+            '| a | b |\n|---|---|\n| 1 | 2 |\n\n',
+        ]))
+    return ''.join(out)
+
+
+def split_stream(text: str, rng: random.Random, lo: int = 1, hi: int = 16) -> list[str]:
+    out, i = [], 0
+    while i < len(text):
+        n = rng.randint(lo, hi)
+        out.append(text[i:i + n])
+        i += n
+    return out
+
+
+def run_renderer(cls, service: EditService, chunks: list[str]) -> tuple[float, str]:
+    r, out, t0 = cls(service, []), [], time.perf_counter()
+    for c in chunks: out.append(r.feed(c))
+    out.append(r.finish())
+    return time.perf_counter() - t0, ''.join(out)
+
+
+def bench_display(size_kb: int):
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as d:
+        (Path(d) / 'data.txt').write_text(''.join(f'line {i}\n' for i in range(1000)), encoding='utf-8')
+        service = EditService(Path(d).resolve())
+        print(f'{"corpus":<10} {"size":>9} {"legacy MB/s":>12} {"current MB/s":>13} {"speedup":>8}')
+        for kind in ('prose', 'edits', 'long-line'):
+            text = display_corpus(kind, size_kb * 1024, rng)
+            chunks, mb = split_stream(text, rng), len(text.encode('utf-8')) / 1e6
+            (t_old, out_old), (t_new, out_new) = run_renderer(LegacyDisplayRenderer, service, chunks), run_renderer(DisplayRenderer, service, chunks)
+            if out_old != out_new: raise AssertionError(f'{kind}: renderer outputs differ')
+            print(f'{kind:<10} {len(text):>9} {mb / t_old:>12.2f} {mb / t_new:>13.2f} {t_old / t_new:>7.1f}x')
+
+
+@dataclass(slots=True)
+class StrRun:
+    raw_buffer: str = ''
+    display_delta: str = ''
+    display_text: str = ''
+    raw_text: str = ''
+
+
+@dataclass(slots=True)
+class BufferRun:
+    raw_buffer: TextBuffer
+    display_delta: TextBuffer
+    display: TextBuffer
+
+
+def stream_str(tokens: list[str], flush_every: int) -> list[float]:
+    r, marks, t0 = StrRun(), [], time.perf_counter()
+    for i, tok in enumerate(tokens, 1):
+        r.raw_buffer += tok
+        r.display_delta += tok
+        if i % flush_every == 0:
+            delta, r.display_delta = r.display_delta, ''
+            r.display_text, r.raw_text = r.display_text + delta, r.raw_buffer
+            marks.append(time.perf_counter() - t0)
+    return marks
+
+
+def stream_buffer(tokens: list[str], flush_every: int) -> list[float]:
+    r, marks, t0 = BufferRun(TextBuffer(), TextBuffer(), TextBuffer()), [], time.perf_counter()
+    for i, tok in enumerate(tokens, 1):
+        r.raw_buffer.append(tok)
+        r.display_delta.append(tok)
+        if i % flush_every == 0:
+            r.display.append(r.display_delta.take())
+            marks.append(time.perf_counter() - t0)
+    str(r.raw_buffer), str(r.display)
+    return marks
+
+
+def bench_buffer(n_tokens: int, flush_every: int = 64):
+    rng = random.Random(0)
+    tokens = [rng.choice(['the', ' quick', ' brown', ' fox', '\n', ' `code`', ' jumps', ' over', '.', ' lazy', ' dog']) * rng.randint(1, 3) for _ in range(n_tokens)]
+    print(f'{"buffer":<11} {"first 10% ns/token":>19} {"last 10% ns/token":>18} {"total ms":>9}')
+    for name, fn in (('str concat', stream_str), ('TextBuffer', stream_buffer)):
+        marks = fn(tokens, flush_every)
+        k = max(1, len(marks) // 10)
+        first, last = marks[k - 1] / (k * flush_every), (marks[-1] - marks[-k - 1]) / (k * flush_every)
+        print(f'{name:<11} {first * 1e9:>19.0f} {last * 1e9:>18.0f} {marks[-1] * 1e3:>9.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target', choices=['display', 'buffer'])
+    parser.add_argument('--size', type=int, default=256, help='corpus size in KiB')
+    parser.add_argument('--tokens', type=int, default=100000, help='streamed tokens for the buffer benchmark')
+    args = parser.parse_args()
+    if args.target == 'display': bench_display(args.size)
+    else: bench_buffer(args.tokens)
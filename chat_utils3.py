@@ -1,7 +1,14 @@
-import asyncio, contextlib, json, os, re, tempfile
-from dataclasses import dataclass, field
+import asyncio, bisect, codecs, contextlib, hashlib, json, mmap, os, re, sqlite3, tempfile, threading, time
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any, AsyncGenerator, Literal
+from typing import Any, AsyncGenerator, Callable, Iterable, Iterator, Literal
+from uuid import uuid4
+
+import zstandard as zstd
+try: import fcntl
+except ImportError: fcntl = None
 
 from openai import AsyncOpenAI
 from stuff import CHAT_PROMPT, EDIT_PROMPT, EXTRACT_ADD_ON
@@ -16,6 +23,16 @@ DEFAULT_REASONING = 'medium'
 MODELS = ['google/gemini-3.1-pro-preview', 'openai/gpt-5.4', 'openai/gpt-5.4-pro', 'openai/gpt-5.4-mini', 'anthropic/claude-4.7-opus', 'moonshotai/kimi-k2.6']
 REASONING_LEVELS = ['none', 'low', 'medium', 'high', 'xhigh']
 MAX_ATTACHMENT_BYTES = 500 * 1024
+UNDO_DIR = Path(os.getenv('CHAT_UNDO_DIR') or Path(__file__).resolve().with_name('.chat_undo'))
+UNDO_MAX_ROUNDS = 200
+UNDO_MAX_BYTES = 64 << 20
+EDIT_WORKERS = 4
+ZSTD_DICT_PATH = Path(os.getenv('CHAT_ZSTD_DICT') or Path(__file__).resolve().with_name('chat.zdict'))
+ZSTD_DICT_BYTES = 112 << 10
+LOCK_DIR = Path(os.getenv('CHAT_LOCK_DIR') or Path(tempfile.gettempdir()) / 'chat-locks')
+STORE_PATH = Path(os.getenv('CHAT_STORE') or Path(__file__).resolve().with_name('chat.sqlite3'))
+STORE_PAGE = 24
+STORE_BLOB_MIN = 4096
 
 FILE_LIKE_EXTS = {'.py', '.pyw', '.ipynb', '.js', '.mjs', '.cjs', '.ts', '.tsx', '.c', '.cc', '.cpp', '.cxx', '.h', '.hpp', '.hh', '.hxx', '.go', '.rs', '.cs', '.java', '.html', '.svelte', '.htm', '.css', '.md', '.markdown', '.txt', '.rst', '.json', '.yaml', '.yml', '.toml', '.sql', '.sh', '.bash', '.zsh', '.bat', '.ps1'}
 ATTACHMENTS_MARKER = '\n\Attachments:\n'
@@ -39,12 +56,12 @@ class Attachment:
 @dataclass(slots=True)
 class EditItem:
     label: str
-    status: Literal['pending', 'success', 'partial', 'error']
+    status: Literal['pending', 'staged', 'success', 'partial', 'error']
 
 
 @dataclass(slots=True)
 class EditRound:
-    status: Literal['pending', 'success', 'partial', 'rejected', 'error']
+    status: Literal['pending', 'applying', 'success', 'partial', 'rejected', 'error']
     items: list[EditItem] = field(default_factory=list)
     text: str = ''
 
@@ -54,6 +71,9 @@ class PendingEdit:
     assistant_id: str
     text: str
     targets: list[str] = field(default_factory=list)
+    resolved: int = 0
+    checked: int = 0
+    plan: 'EditPlan | None' = None
 
 
 @dataclass(slots=True)
@@ -79,6 +99,7 @@ class AssistantTurn:
     interrupted: bool = False
     error: str | None = None
     has_answer: bool = False
+    live: 'TextBuffer | None' = field(default=None, repr=False, compare=False)  # the raw text of its run while it streams; not stored
 
 
 @dataclass(slots=True)
@@ -105,9 +126,77 @@ Entry = ExchangeEntry | CouncilEntry
 
 @dataclass(slots=True)
 class ConversationState:
+    """Conversation entries plus id indexes; mutate `entries` through append/pop/clear/add_turn/prepend so the indexes stay in step.
+    `entries` may be only the newest part of a stored conversation: the `offset` entries before it are still in the store."""
     entries: list[Entry] = field(default_factory=list)
     pending_edit: PendingEdit | None = None
     edit_rounds: dict[str, EditRound] = field(default_factory=dict)
+    journal_id: str = field(default_factory=lambda: uuid4().hex)
+    id: str = field(default_factory=lambda: uuid4().hex)
+    offset: int = 0
+    entry_index: dict[str, Entry] = field(default_factory=dict, repr=False, compare=False)
+    turn_index: dict[str, tuple[Entry, AssistantTurn]] = field(default_factory=dict, repr=False, compare=False)
+
+    @staticmethod
+    def turns(e: Entry) -> list[AssistantTurn]: return [e.assistant] if isinstance(e, ExchangeEntry) else [*e.members, *([e.synthesis] if e.synthesis else [])]
+
+    def reindex(self):
+        self.entry_index, self.turn_index = {e.id: e for e in self.entries}, {a.id: (e, a) for e in self.entries for a in self.turns(e)}
+
+    def append(self, e: Entry):
+        self.entries.append(e)
+        self.entry_index[e.id] = e
+        for a in self.turns(e): self.turn_index[a.id] = (e, a)
+
+    def add_turn(self, e: Entry, a: AssistantTurn): self.turn_index[a.id] = (e, a)
+
+    def pop(self) -> Entry:
+        e = self.entries.pop()
+        self.entry_index.pop(e.id, None)
+        for a in self.turns(e): self.turn_index.pop(a.id, None)
+        return e
+
+    def clear(self): self.entries, self.entry_index, self.turn_index, self.offset = [], {}, {}, 0
+
+    def prepend(self, older: list[Entry]):
+        self.entries[:0], self.offset = older, self.offset - len(older)
+        self.reindex()
+
+    def seq(self, e: Entry) -> int: return self.offset + (len(self.entries) - 1 if self.entries and self.entries[-1] is e else self.entries.index(e))
+
+    def entry(self, entry_id: str) -> Entry | None: return self.entry_index.get(entry_id)
+
+    def turn(self, assistant_id: str) -> tuple[Entry | None, AssistantTurn | None]: return self.turn_index.get(assistant_id) or (None, None)
+
+    def editable(self, assistant_id: str) -> bool:
+        return (t := self.turn_index.get(assistant_id)) is not None and (isinstance(t[0], ExchangeEntry) or t[0].synthesis is t[1])
+
+
+@dataclass(slots=True)
+class TextBuffer:
+    """Append-only text kept as a chunk list; the joined string is built lazily and cached until the next append."""
+    parts: list[str] = field(default_factory=list)
+    size: int = 0
+    text: str | None = ''
+
+    def append(self, s: str) -> 'TextBuffer':
+        if s:
+            self.parts.append(s)
+            self.size, self.text = self.size + len(s), None
+        return self
+
+    def clear(self): self.parts, self.size, self.text = [], 0, ''
+    def __len__(self) -> int: return self.size
+    def __bool__(self) -> bool: return self.size > 0
+
+    def __str__(self) -> str:
+        if self.text is None: self.text, self.parts = (t := ''.join(self.parts)), [t]
+        return self.text
+
+    def take(self) -> str:
+        out = str(self)
+        self.clear()
+        return out
 
 
 @dataclass(slots=True)
@@ -144,6 +233,44 @@ class EditDirective:
     full_new: str | None = None
 
 
+@dataclass(slots=True)
+class PlannedEdit:
+    directive: EditDirective
+    rel: str | None = None
+    error: str = ''
+    digest: str | None = None
+    spans: list[tuple[int, int] | None] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class EditPlan:
+    edits: list[PlannedEdit] = field(default_factory=list)
+    ctx_files: list[str] = field(default_factory=list)
+
+    @property
+    def checked(self) -> int: return sum(len(x.directive.replaces) for x in self.edits)
+
+    @property
+    def resolved(self) -> int: return sum(span is not None for x in self.edits for span in x.spans)
+
+
+@dataclass(slots=True)
+class StagedFile:
+    rel: str
+    path: Path
+    tmp: str | None = None
+    runs: list[tuple[int, int, int]] = field(default_factory=list)
+    undo: tuple[str, str, bytes] | None = None
+    events: list[tuple[int, 'EditEvent']] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+    error: tuple[int, str] | None = None
+
+    def discard(self):
+        if self.tmp:
+            with contextlib.suppress(OSError): os.unlink(self.tmp)
+        self.tmp = None
+
+
 @dataclass(slots=True)
 class DisplayCommandState:
     op: Literal['replace', 'insert_after', 'insert_before']
@@ -297,6 +424,537 @@ def read_files(file_paths: list[str]) -> str:
     return AttachmentService.read_files(file_paths)
 
 
+class PositionMap:
+    """Maps original line boundaries to current ones; Fenwick tree of offsets so every splice is O(log n)."""
+
+    def __init__(self, n: int):
+        self.n, self.tree, self.dead = n + 1, [0] * (n + 2), bytearray(n + 1)
+
+    def _add(self, j: int, v: int):
+        j += 1
+        while j <= self.n:
+            self.tree[j] += v
+            j += j & -j
+
+    def _pos(self, j: int) -> int:
+        s, k = j, j + 1
+        while k > 0:
+            s += self.tree[k]
+            k -= k & -k
+        return s
+
+    def get(self, j: int) -> int | None: return None if self.dead[j] else self._pos(j)
+
+    def first_above(self, x: int) -> int:
+        # Dead boundaries are pinned to the start of the span that removed them, so positions stay monotone for the descent.
+        i, acc, step = 0, 0, 1 << self.n.bit_length()
+        while step:
+            if (k := i + step) <= self.n and k - 1 + acc + self.tree[k] <= x: i, acc = k, acc + self.tree[k]
+            step >>= 1
+        return i
+
+    def shift(self, j: int, k: int):
+        if k and j < self.n: self._add(j, k)
+
+    def kill(self, lo: int, hi: int, at: int):
+        for j in range(lo, hi):
+            self.dead[j] = 1
+            if d := at - self._pos(j): self._add(j, d), self._add(j + 1, -d)
+
+    def splice(self, i0: int, i1: int, k: int, op: str, s: int | None = None, t: int | None = None):
+        if op == 'replace':
+            lo, hi = (s + 1, t) if s is not None else (self.first_above(i0), self.first_above(i1 - 1))
+            self.kill(lo, hi, i0)
+            self.shift(hi, k - (i1 - i0))
+        elif op == 'insert_before': self.shift(s if s is not None else self.first_above(i0 - 1), k)
+        else: self.shift(t + 1 if t is not None else self.first_above(i0), k)
+
+
+class TextDocument:
+    """Line piece table over a memory-mapped file: splices reference original byte ranges and only added lines live in memory."""
+    _EOL_RE = re.compile(rb'\r\n|\r|\n')
+    _CHUNK = 1 << 20
+
+    def __init__(self, data: Any, starts: array, ends: array, pieces: list[tuple[list[str] | None, int, int]] | None = None):
+        self.data, self.starts, self.ends = data, starts, ends
+        self.pieces = pieces if pieces is not None else [(None, 0, len(starts))]
+        self.size = sum(b - a for _, a, b in self.pieces)
+        self.eol = '\r\n' if data.find(b'\r\n') >= 0 else '\n'
+        self.final_nl = len(data) > 0 and data[-1:] in (b'\n', b'\r')
+
+    @classmethod
+    def open(cls, path: Path) -> 'TextDocument':
+        with open(path, 'rb') as f: data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        try:
+            dec = codecs.getincrementaldecoder('utf-8')()
+            for i in range(0, len(data), cls._CHUNK): dec.decode(data[i:i + cls._CHUNK])
+            dec.decode(b'', final=True)
+            starts, ends = array('q', [0]), array('q')
+            for m in cls._EOL_RE.finditer(data): ends.append(m.start()), starts.append(m.end())
+            if len(starts) > 1 and starts[-1] == len(data): starts.pop()
+            else: ends.append(len(data))
+        except BaseException:
+            if isinstance(data, mmap.mmap): data.close()
+            raise
+        return cls(data, starts, ends)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap): self.data.close()
+
+    def __enter__(self) -> 'TextDocument': return self
+    def __exit__(self, *exc): self.close()
+    def __len__(self) -> int: return self.size
+
+    def _line(self, i: int) -> str: return self.data[self.starts[i]:self.ends[i]].decode('utf-8')
+
+    def _iter_piece(self, src: list[str] | None, a: int, b: int) -> Iterator[str]:
+        return iter(src[a:b]) if src is not None else map(self._line, range(a, b))
+
+    def __iter__(self) -> Iterator[str]:
+        for src, a, b in self.pieces: yield from self._iter_piece(src, a, b)
+
+    def original(self) -> 'TextDocument':
+        return TextDocument(self.data, self.starts, self.ends, [(None, 0, len(self.starts))])
+
+    def _cut(self, i: int) -> int:
+        # Split the piece containing line i so that a piece starts exactly at i; returns that piece's index.
+        at = 0
+        for k, (src, a, b) in enumerate(self.pieces):
+            if i == at: return k
+            if i < at + b - a:
+                self.pieces[k:k + 1] = [(src, a, a + i - at), (src, a + i - at, b)]
+                return k + 1
+            at += b - a
+        return len(self.pieces)
+
+    def __getitem__(self, i: int | slice) -> str | list[str]:
+        if isinstance(i, slice): return self.lines(*i.indices(self.size)[:2])
+        if not 0 <= i < self.size: raise IndexError(i)
+        return self.lines(i, i + 1)[0]
+
+    def hits(self, x: str, norm, start: int = 0) -> Iterator[int]:
+        """Indices >= start of lines with norm(line) == norm(x); original pieces are searched in the mapped bytes."""
+        want, at = norm(x), 0
+        needle = want.encode('utf-8')
+        for src, a, b in self.pieces:
+            if at + b - a <= start:
+                at += b - a
+                continue
+            lo = a + max(0, start - at)
+            if src is not None or not needle:
+                yield from (at + i - a for i in range(lo, b) if norm(src[i] if src is not None else self._line(i)) == want)
+            else:
+                pos, end = self.starts[lo], self.ends[b - 1]
+                while (pos := self.data.find(needle, pos, end)) >= 0:
+                    i = bisect.bisect_right(self.starts, pos, lo, b) - 1
+                    if self.starts[i] == pos and norm(self._line(i)) == want: yield at + i - a
+                    if i + 1 >= b: break
+                    pos = self.starts[i + 1]
+            at += b - a
+
+    def lines(self, i0: int, i1: int) -> list[str]:
+        out, at = [], 0
+        for src, a, b in self.pieces:
+            lo, hi = max(i0, at), min(i1, at + b - a)
+            if lo < hi: out += self._iter_piece(src, a + lo - at, a + hi - at)
+            if (at := at + b - a) >= i1: break
+        return out
+
+    def splice(self, i0: int, i1: int, new: list[str]) -> bool:
+        if self.lines(i0, i1) == new: return False
+        k0 = self._cut(i0)
+        k1 = self._cut(i1)
+        self.pieces[k0:k1] = [(new, 0, len(new))] if new else []
+        self.size += len(new) - (i1 - i0)
+        return True
+
+    def unchanged(self) -> bool:
+        if self.size != len(self.starts): return False
+        at = 0
+        for src, a, b in self.pieces:
+            # Original pieces still sitting at their own offset compare equal without decoding.
+            if (src is not None or a != at) and any(x != self._line(i) for i, x in zip(range(at, at + b - a), self._iter_piece(src, a, b))): return False
+            at += b - a
+        return True
+
+    def runs(self) -> list[tuple[int, int, int]]:
+        """(line, original line, length) for every stretch still backed by the original file."""
+        out, at = [], 0
+        for src, a, b in self.pieces:
+            if src is None and b > a: out.append((at, a, b - a))
+            at += b - a
+        return out
+
+    def count_lines(self) -> int: return 0 if self.size == 0 or self.size == 1 and next(iter(self)) == '' else self.size
+
+    def chunks(self, batch: int = 4096) -> Iterator[str]:
+        buf, first = [], True
+        for line in self:
+            buf.append(line)
+            if len(buf) >= batch:
+                yield ('' if first else self.eol) + self.eol.join(buf)
+                buf, first = [], False
+        if buf: yield ('' if first else self.eol) + self.eol.join(buf)
+        if self.final_nl: yield self.eol
+
+
+class ZstdCodec:
+    """zstd with the optional dictionary at `ZSTD_DICT_PATH`, trained offline (`train`) from past conversations.
+
+    Small, repetitive payloads (prompts, edit directives, the same source files) compress several times better
+    against it. Frames carry the dictionary id, so data written without one stays readable after one is installed,
+    and a retrained dictionary retires the previous one to `<stem>.<dict id><suffix>` next to it, which is still
+    loaded for reading what was written with it.
+    """
+    def __init__(self, path: Path | None = ZSTD_DICT_PATH):
+        self.data = path.read_bytes() if path and path.is_file() else b''
+        self.dict = zstd.ZstdCompressionDict(self.data) if self.data else None
+        self.id = self.dict.dict_id() if self.dict else 0
+        self.retired = {d.dict_id(): d for f in (sorted(path.parent.glob(f'{path.stem}.*{path.suffix}')) if path else []) if (d := zstd.ZstdCompressionDict(f.read_bytes())).dict_id()}
+        self.sha256 = hashlib.sha256(self.data).digest() if self.data else b''
+        self.local = threading.local()
+
+    def compressor(self, level: int = 9) -> zstd.ZstdCompressor:
+        cache = self.local.__dict__.setdefault('c', {})  # compressors are not thread-safe, and loading the dictionary is not free
+        return cache.get(level) or cache.setdefault(level, zstd.ZstdCompressor(level=level, dict_data=self.dict))
+
+    def compress(self, data: bytes, level: int = 9) -> bytes: return self.compressor(level).compress(data)
+
+    def decompress(self, payload: bytes) -> bytes:
+        if (need := zstd.get_frame_parameters(payload).dict_id) and need != self.id and need not in self.retired: raise ValueError(f'zstd frame needs dictionary {need}, have {self.id or "none"}')
+        cache = self.local.__dict__.setdefault('d', {})
+        return (cache.get(need) or cache.setdefault(need, zstd.ZstdDecompressor(dict_data=None if not need else self.dict if need == self.id else self.retired[need]))).decompress(payload)
+
+    @staticmethod
+    def retire(path: Path = ZSTD_DICT_PATH) -> Path | None:
+        """Move the dictionary at `path` aside (as `<stem>.<dict id><suffix>`) before a new one replaces it."""
+        if not path.is_file() or not (i := zstd.ZstdCompressionDict(path.read_bytes()).dict_id()): return None
+        path.replace(old := path.with_name(f'{path.stem}.{i}{path.suffix}'))
+        return old
+
+    @staticmethod
+    def train(samples: Iterable[bytes], size: int = ZSTD_DICT_BYTES) -> bytes: return zstd.train_dictionary(size, [x for x in samples if x]).as_bytes()
+
+
+ZSTD = ZstdCodec()
+
+
+class UndoJournal:
+    """Append-only on-disk log of reverse diffs, one record per edit round; memory only holds the index of payload offsets.
+
+    Open journals through `open`, which shares one instance per file within a process, so a reloading tab can take it
+    over before its old client is gone. With `fcntl`, a journal belongs to one worker process at a time, since its
+    index lives in memory.
+    """
+    guard, shared = threading.Lock(), dict[Path, 'UndoJournal']()
+
+    def __init__(self, path: Path | None = None, max_rounds: int = UNDO_MAX_ROUNDS, max_bytes: int = UNDO_MAX_BYTES):
+        self.path, self.max_rounds, self.max_bytes = path, max_rounds, max_bytes
+        self.entries: list[dict[str, Any]] = []
+        self.seq, self.live, self.lock, self.refs, self.owner = 0, 0, threading.Lock(), 0, None
+        if path is None:
+            self.f = tempfile.TemporaryFile()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if fcntl:
+                self.owner = open(path.with_suffix('.owner'), 'a+b')
+                try: fcntl.flock(self.owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self.owner.close()
+                    raise RuntimeError(f'Undo journal {path.name} is open in another worker process') from None
+            self.f = open(path, 'a+b')
+            self._load()
+
+    @classmethod
+    def open(cls, path: Path) -> 'UndoJournal':
+        with cls.guard:
+            if not (j := cls.shared.get(path)): j = cls.shared[path] = cls(path)
+            j.refs += 1
+            return j
+
+    def release(self):
+        with UndoJournal.guard:
+            self.refs -= 1
+            if self.refs > 0: return
+            if UndoJournal.shared.get(self.path) is self: del UndoJournal.shared[self.path]
+        self.close()
+
+    @staticmethod
+    def pack(hunks: Iterable[tuple[int, int, bytes]]) -> bytes:
+        hunks = list(hunks)
+        return ZSTD.compress(json.dumps([[a, b, len(x)] for a, b, x in hunks]).encode() + b'\n' + b''.join(x for *_, x in hunks))
+
+    @staticmethod
+    def unpack(payload: bytes) -> list[tuple[int, int, bytes]]:
+        raw = ZSTD.decompress(payload) if payload else b'[]\n'
+        out, at = [], raw.index(b'\n') + 1
+        for a, b, n in json.loads(raw[:at]):
+            out.append((a, b, raw[at:at + n]))
+            at += n
+        return out
+
+    def _append(self, head: dict[str, Any], payloads: list[bytes] = ()) -> int:
+        line = json.dumps(head).encode() + b'\n'
+        self.f.seek(0, os.SEEK_END)
+        off = self.f.tell() + len(line)
+        self.f.write(line + b''.join(payloads))
+        self.f.flush()
+        if self.path: os.fsync(self.f.fileno())
+        return off
+
+    def _index(self, head: dict[str, Any], off: int) -> dict[str, Any]:
+        files = {}
+        for rel, kind, after, n in head['files']:
+            files[rel], off = (kind, after, off, n), off + n
+        entry = {'seq': head['seq'], 'assistant_id': head['assistant_id'], 'files': files, 'changed': set(files)}
+        self.entries.append(entry)
+        self.live += sum(x[3] for x in files.values())
+        return entry
+
+    def _retain(self) -> list[dict[str, Any]]:
+        out = []
+        while len(self.entries) > self.max_rounds or self.live > self.max_bytes and len(self.entries) > 1:
+            out.append({'t': 'drop', 'seq': self.entries[0]['seq'], 'rels': sorted(self.entries[0]['changed'])})
+            self._forget(self.entries[0])
+        return out
+
+    def _forget(self, entry: dict[str, Any], rels: Iterable[str] | None = None):
+        for rel in list(entry['changed'] if rels is None else rels):
+            entry['changed'].discard(rel)
+            if x := entry['files'].pop(rel, None): self.live -= x[3]
+        if not entry['changed'] and entry in self.entries: self.entries.remove(entry)
+
+    def _load(self):
+        self.f.seek(0, os.SEEK_END)
+        size, pos = self.f.tell(), 0
+        self.f.seek(0)
+        while line := self.f.readline():
+            try: head = json.loads(line) if line.endswith(b'\n') else None
+            except ValueError: head = None
+            if not isinstance(head, dict): break
+            if head.get('t') == 'tx':
+                off = pos + len(line)
+                if off + sum(x[3] for x in head['files']) > size: break
+                self._index(head, off)
+                self._retain()
+                self.f.seek(off + sum(x[3] for x in head['files']))
+            elif head.get('t') == 'drop' and (e := next((e for e in self.entries if e['seq'] == head['seq']), None)):
+                self._forget(e, head['rels'])
+            self.seq, pos = max(self.seq, head.get('seq', 0)), self.f.tell()
+        if pos < size: self.f.truncate(pos)
+
+    def _read_at(self, off: int, n: int) -> bytes:
+        # seek + read rather than os.pread, which Windows lacks; callers hold `lock`, and appends seek to the end first.
+        self.f.seek(off)
+        return self.f.read(n)
+
+    def _compact(self):
+        if not self.path or self.f.seek(0, os.SEEK_END) <= 2 * self.live + (1 << 20): return
+        tmp, moved = self.path.with_suffix('.compact'), []
+        with open(tmp, 'wb') as out:
+            for e in self.entries:
+                head = {'t': 'tx', 'seq': e['seq'], 'assistant_id': e['assistant_id'], 'files': [[rel, kind, after, n] for rel, (kind, after, _, n) in e['files'].items()]}
+                line = json.dumps(head).encode() + b'\n'
+                out.write(line)
+                off = out.tell()
+                for rel, (kind, after, at, n) in e['files'].items():
+                    out.write(self._read_at(at, n))
+                    moved.append((e['files'], rel, (kind, after, off, n)))
+                    off += n
+            out.flush()
+            os.fsync(out.fileno())
+        self.f.close()  # Windows cannot replace a file that is still open
+        try: os.replace(tmp, self.path)
+        finally: self.f = open(self.path, 'a+b')
+        for files, rel, x in moved: files[rel] = x
+
+    def append(self, assistant_id: str | None, files: list[tuple[str, str, str, bytes]]) -> dict[str, Any]:
+        with self.lock:
+            self.seq += 1
+            head = {'t': 'tx', 'seq': self.seq, 'assistant_id': assistant_id, 'files': [[rel, kind, after, len(p)] for rel, kind, after, p in files]}
+            entry = self._index(head, self._append(head, [p for *_, p in files]))
+            for x in self._retain(): self._append(x)
+            self._compact()
+            return entry
+
+    def read(self, entry: dict[str, Any], rel: str) -> tuple[str, str, list[tuple[int, int, bytes]]]:
+        kind, after, off, n = entry['files'][rel]
+        with self.lock: return kind, after, self.unpack(self._read_at(off, n))
+
+    def drop(self, entry: dict[str, Any], rels: Iterable[str]):
+        with self.lock:
+            rels = [r for r in rels if r in entry['changed']]
+            if not rels: return
+            self._append({'t': 'drop', 'seq': entry['seq'], 'rels': rels})
+            self._forget(entry, rels)
+            self._compact()
+
+    def close(self):
+        self.f.close()
+        if self.owner: self.owner.close()
+
+
+class ConversationStore:
+    """Conversations in SQLite (WAL mode). Each entry is one row, written when appended and again when it settles;
+    edit rounds are stored per assistant turn, and attachment bodies as content-addressed blobs shared between entries.
+    Entries are read back a page at a time from the newest, so opening a long conversation costs one page.
+
+    All SQL runs in order on one thread: writes are queued without waiting, and reads are awaited behind them so the
+    event loop never blocks on the database.
+    """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, journal_id TEXT NOT NULL, title TEXT NOT NULL DEFAULT '', pending BLOB, created REAL NOT NULL, updated REAL NOT NULL);
+    CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+    CREATE TABLE IF NOT EXISTS entries (conversation_id TEXT NOT NULL REFERENCES conversations ON DELETE CASCADE, seq INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS edit_rounds (conversation_id TEXT NOT NULL REFERENCES conversations ON DELETE CASCADE, assistant_id TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (conversation_id, assistant_id)) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS blob_refs (conversation_id TEXT NOT NULL REFERENCES conversations ON DELETE CASCADE, seq INTEGER NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (conversation_id, seq, hash)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS blob_refs_hash ON blob_refs (hash);
+    CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path: Path = STORE_PATH, on_error: Callable[[BaseException], Any] | None = None):
+        self.path, self.on_error, self.db = path, on_error, None
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-store')
+
+    def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('PRAGMA foreign_keys=ON')
+            self.db.executescript(self.SCHEMA)
+        with self.db: return fn(self.db, *args)
+
+    def _report(self, f: Future):
+        if (x := f.exception()) and self.on_error: self.on_error(x)
+
+    def write(self, fn: Callable[..., Any], *args: Any) -> Future:
+        (f := self.pool.submit(self._run, fn, *args)).add_done_callback(self._report)
+        return f
+
+    async def read(self, fn: Callable[..., Any], *args: Any) -> Any: return await asyncio.wrap_future(self.pool.submit(self._run, fn, *args))
+
+    @staticmethod
+    def encode(e: Entry) -> tuple[bytes, dict[str, bytes]]:
+        d, blobs = asdict(e), {}
+        for a in [d['assistant']] if d['kind'] == 'exchange' else [*d['members'], *([d['synthesis']] if d['synthesis'] else [])]: del a['live']
+        for a in (d['user'] if d['kind'] == 'exchange' else d['query'])['attachments']:
+            if len(a['content']) < STORE_BLOB_MIN: continue
+            data = a.pop('content').encode()
+            a['blob'] = h = hashlib.blake2b(data, digest_size=16).hexdigest()
+            blobs[h] = ZSTD.compress(data)
+        return ZSTD.compress(json.dumps(d).encode()), blobs
+
+    @staticmethod
+    def decode(db: sqlite3.Connection, data: bytes) -> Entry:
+        d = json.loads(ZSTD.decompress(data))
+        def user(u: dict[str, Any]) -> UserTurn:
+            for a in u['attachments']:
+                if h := a.pop('blob', None): a['content'] = ZSTD.decompress(row[0]).decode() if (row := db.execute('SELECT data FROM blobs WHERE hash = ?', (h,)).fetchone()) else ''
+            return UserTurn(**{**u, 'attachments': [Attachment(**a) for a in u['attachments']]})
+        if d['kind'] == 'exchange': return ExchangeEntry(d['id'], user(d['user']), AssistantTurn(**d['assistant']))
+        return CouncilEntry(d['id'], user(d['query']), d['member_prompt_text'], [AssistantTurn(**m) for m in d['members']], d['synthesis'] and AssistantTurn(**d['synthesis']), d['status'])
+
+    @staticmethod
+    def _touch(db: sqlite3.Connection, s: tuple[str, str], title: str = ''):
+        db.execute('INSERT INTO conversations (id, journal_id, title, created, updated) VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET updated = excluded.updated, title = CASE WHEN excluded.title != \'\' THEN excluded.title ELSE title END', (*s, title, now := time.time(), now))
+
+    def put_entry(self, s: ConversationState, e: Entry) -> Future:
+        seq, (data, blobs) = s.seq(e), self.encode(e)
+        title = ' '.join((e.user if isinstance(e, ExchangeEntry) else e.query).restore_text.split())[:80] if seq == 0 else ''
+        s_id, journal_id = s.id, s.journal_id
+        def put(db: sqlite3.Connection):
+            self._touch(db, (s_id, journal_id), title)
+            db.execute('INSERT OR REPLACE INTO entries (conversation_id, seq, data) VALUES (?, ?, ?)', (s_id, seq, data))
+            db.execute('DELETE FROM blob_refs WHERE conversation_id = ? AND seq = ?', (s_id, seq))
+            db.executemany('INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)', blobs.items())
+            db.executemany('INSERT INTO blob_refs (conversation_id, seq, hash) VALUES (?, ?, ?)', [(s_id, seq, h) for h in blobs])
+        return self.write(put)
+
+    def drop_entries(self, s: ConversationState, seq: int, assistant_ids: Iterable[str] = ()) -> Future:
+        """Forget the entries from `seq` on (and the edit rounds of their assistant turns)."""
+        s_id, ids = s.id, list(assistant_ids)
+        def drop(db: sqlite3.Connection):
+            db.execute('DELETE FROM entries WHERE conversation_id = ? AND seq >= ?', (s_id, seq))
+            db.execute('DELETE FROM blob_refs WHERE conversation_id = ? AND seq >= ?', (s_id, seq))
+            db.executemany('DELETE FROM edit_rounds WHERE conversation_id = ? AND assistant_id = ?', [(s_id, a) for a in ids])
+            db.execute('DELETE FROM blobs WHERE NOT EXISTS (SELECT 1 FROM blob_refs r WHERE r.hash = blobs.hash)')
+        return self.write(drop)
+
+    def put_edits(self, s: ConversationState, assistant_id: str | None = None) -> Future:
+        """Store the pending edit and, if given, the edit round of `assistant_id` (deleting it if it is gone)."""
+        p = s.pending_edit
+        pending = json.dumps({'assistant_id': p.assistant_id, 'text': p.text, 'targets': p.targets, 'resolved': p.resolved, 'checked': p.checked}).encode() if p else None
+        r = assistant_id and s.edit_rounds.get(assistant_id)
+        data, s_id, journal_id = r and ZSTD.compress(json.dumps(asdict(r)).encode()), s.id, s.journal_id
+        def put(db: sqlite3.Connection):
+            self._touch(db, (s_id, journal_id))
+            db.execute('UPDATE conversations SET pending = ? WHERE id = ?', (pending, s_id))
+            if data: db.execute('INSERT OR REPLACE INTO edit_rounds (conversation_id, assistant_id, data) VALUES (?, ?, ?)', (s_id, assistant_id, data))
+            elif assistant_id: db.execute('DELETE FROM edit_rounds WHERE conversation_id = ? AND assistant_id = ?', (s_id, assistant_id))
+        return self.write(put)
+
+    async def conversations(self, limit: int = 50) -> list[dict[str, Any]]:
+        return await self.read(lambda db: [dict(id=i, title=t, updated=u, entries=n) for i, t, u, n in db.execute('SELECT id, title, updated, (SELECT COUNT(*) FROM entries e WHERE e.conversation_id = c.id) FROM conversations c ORDER BY updated DESC LIMIT ?', (limit,))])
+
+    @classmethod
+    def _page(cls, db: sqlite3.Connection, conversation_id: str, before: int, limit: int) -> tuple[list[Entry], dict[str, EditRound]]:
+        rows = db.execute('SELECT data FROM entries WHERE conversation_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?', (conversation_id, before, limit)).fetchall()
+        entries = [cls.decode(db, data) for data, in reversed(rows)]
+        ids = [a.id for e in entries for a in ConversationState.turns(e)]
+        rounds = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for aid, data in db.execute(f'SELECT assistant_id, data FROM edit_rounds WHERE conversation_id = ? AND assistant_id IN ({",".join("?" * len(chunk))})', (conversation_id, *chunk)):
+                d = json.loads(ZSTD.decompress(data))
+                rounds[aid] = EditRound(d['status'], [EditItem(**x) for x in d['items']], d['text'])
+        return entries, rounds
+
+    async def page(self, s: ConversationState, limit: int = STORE_PAGE) -> tuple[list[Entry], dict[str, EditRound]]:
+        """The up to `limit` entries just before the loaded ones, with their edit rounds."""
+        return await self.read(self._page, s.id, s.offset, limit) if s.offset > 0 else ([], {})
+
+    async def load(self, conversation_id: str, limit: int = STORE_PAGE) -> ConversationState | None:
+        def load(db: sqlite3.Connection) -> ConversationState | None:
+            if not (row := db.execute('SELECT journal_id, pending, (SELECT COALESCE(MAX(seq) + 1, 0) FROM entries WHERE conversation_id = ?) FROM conversations WHERE id = ?', (conversation_id, conversation_id)).fetchone()): return None
+            journal_id, pending, n = row
+            entries, rounds = self._page(db, conversation_id, n, limit)
+            return ConversationState(entries, PendingEdit(**json.loads(pending)) if pending else None, rounds, journal_id, conversation_id, n - len(entries))
+        return await self.read(load)
+
+
+class PathLocks:
+    """Per-path locks shared by every EditService so concurrent tabs never interleave writes to the same file. With
+    `fcntl`, each one also holds an flock on a file under `lock_dir`, so the same goes for other worker processes."""
+
+    def __init__(self, lock_dir: Path | None = LOCK_DIR):
+        self.guard, self.locks, self.lock_dir = threading.Lock(), {}, lock_dir if fcntl else None
+
+    @contextlib.contextmanager
+    def flock(self, key: str) -> Iterator[None]:
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_dir / f'{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.lock', 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def hold(self, paths: Iterable[Path]) -> Iterator[None]:
+        # Sorted acquisition (thread lock, then flock, per path) keeps overlapping multi-file holds deadlock-free across processes too.
+        keys = sorted({str(p) for p in paths})
+        with self.guard: locks = [self.locks.setdefault(k, threading.Lock()) for k in keys]
+        with contextlib.ExitStack() as stack:
+            for k, lk in zip(keys, locks):
+                stack.enter_context(lk)
+                if self.lock_dir: stack.enter_context(self.flock(k))
+            yield
+
+
+EDIT_POOL = ThreadPoolExecutor(max_workers=EDIT_WORKERS, thread_name_prefix='chat-edit')
+PATH_LOCKS = PathLocks()
+
+
 class EditService:
     _EDIT_HDR_RE = re.compile(r'^\s*###\s*Edit\s+(.+?)\s*$', re.IGNORECASE)
     _COMMAND_HDR_RE = re.compile(r'^\s*####\s*(Replace|Insert After|Insert Before|Write)\s*$', re.IGNORECASE)
@@ -304,25 +962,38 @@ class EditService:
     _FENCE_OPEN_RE = re.compile(r'^\s*```[ \t]*([^\n`]*)\s*$')
     _FENCE_CLOSE_RE = re.compile(r'^\s*```\s*$')
     _OPS = {'replace': 'replace', 'insert after': 'insert_after', 'insert before': 'insert_before', 'write': 'write'}
+    _STAGE_WORKERS = 8
     _LABELS = {'replace': 'Replace', 'insert_after': 'Insert After', 'insert_before': 'Insert Before'}
 
-    def __init__(self, base_dir: Path):
+    def __init__(self, base_dir: Path, journal: UndoJournal | None = None):
         self.base_dir = base_dir
         self.edited_files: dict[str, bool] = {}
-        self.transactions: list[dict[str, Any]] = []
+        self.attach_journal(journal or UndoJournal())
+
+    def attach_journal(self, journal: UndoJournal):
+        self.journal, self.transactions = journal, journal.entries
+        self._rebuild_edited_files()
 
     @staticmethod
     def _norm_newlines(s: str) -> str: return (s or '').replace('\r\n', '\n').replace('\r', '\n')
 
     @staticmethod
-    def _atomic_write(path: Path, content: str):
+    def _write_temp(path: Path, content: str | Iterable[str] | Iterable[bytes], newline: str | None = None, binary: bool = False) -> str:
         path.parent.mkdir(parents=True, exist_ok=True)
-        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=str(path.parent), delete=False) as tmp:
-            tmp.write(content)
-            tmp.flush()
-            with contextlib.suppress(Exception): os.fsync(tmp.fileno())
-            name = tmp.name
-        os.replace(name, str(path))
+        with tempfile.NamedTemporaryFile('wb', dir=str(path.parent), delete=False) if binary else tempfile.NamedTemporaryFile('w', encoding='utf-8', newline=newline, dir=str(path.parent), delete=False) as tmp:
+            try:
+                tmp.writelines([content] if isinstance(content, (str, bytes)) else content)
+                tmp.flush()
+                with contextlib.suppress(Exception): os.fsync(tmp.fileno())
+            except BaseException:
+                tmp.close()
+                with contextlib.suppress(OSError): os.unlink(tmp.name)
+                raise
+            return tmp.name
+
+    @classmethod
+    def _atomic_write(cls, path: Path, content: str | Iterable[str] | Iterable[bytes], newline: str | None = None, binary: bool = False):
+        os.replace(cls._write_temp(path, content, newline, binary), str(path))
 
     @staticmethod
     def _count_lines_norm(s: str) -> int:
@@ -348,37 +1019,49 @@ class EditService:
         if j >= len(lines): return None
         return (m.group(1) or '').strip(), '\n'.join(lines[i + 1:j]), j + 1
 
+    @staticmethod
+    def _same(s: str) -> str: return s
+
+    @staticmethod
+    def _rstripped(s: str) -> str: return (s or '').rstrip()
+
+    @staticmethod
+    def _hits(lines: 'list[str] | TextDocument', x: str, norm, start: int = 0) -> Iterator[int]:
+        if isinstance(lines, (TextDocument, Snapshot)): return lines.hits(x, norm, start)
+        want = norm(x)
+        return (i for i in range(start, len(lines)) if norm(lines[i]) == want)
+
     @classmethod
-    def _find_replace_span(cls, lines: list[str], a1: str, a2: str, z: str) -> tuple[int, int] | None:
+    def _find_replace_span(cls, lines: 'list[str] | TextDocument', a1: str, a2: str, z: str) -> tuple[int, int] | None:
         if len(lines) < 2: return None
 
         def run(norm) -> tuple[int, int] | None:
-            vals, x1, x2, y = [norm(v) for v in lines], norm(a1), norm(a2), norm(z)
-            cands = []
-            for i in range(len(vals) - 1):
-                if vals[i] != x1 or vals[i + 1] != x2: continue
-                for j in range(i + 1, len(vals)):
-                    if vals[j] == y:
-                        cands.append((i, j))
-                        break
-            return (cands[0][0] + 1, cands[0][1] + 1) if len(cands) == 1 else None
-
-        return run(lambda s: s) or run(lambda s: (s or '').rstrip())
-    
+            x2, found = norm(a2), []
+            for i in cls._hits(lines, a1, norm):
+                if i + 1 >= len(lines) or norm(lines[i + 1]) != x2 or (j := next(cls._hits(lines, z, norm, i + 1), None)) is None: continue
+                found.append((i, j))
+                if len(found) > 1: return None
+            return (found[0][0] + 1, found[0][1] + 1) if len(found) == 1 else None
+
+        return run(cls._same) or run(cls._rstripped)
+
     @classmethod
-    def _find_block_span(cls, lines: list[str], block: str) -> tuple[int, int] | None:
+    def _find_block_span(cls, lines: 'list[str] | TextDocument', block: str) -> tuple[int, int] | None:
         if not lines or block == '': return None
         want = cls._split_lines(block)
         if not want: return None
 
         def run(norm) -> tuple[int, int] | None:
-            vals, xs, n = [norm(v) for v in lines], [norm(v) for v in want], len(want)
-            cands = [i for i in range(len(vals) - n + 1) if vals[i:i + n] == xs]
-            return (cands[0] + 1, cands[0] + n) if len(cands) == 1 else None
+            xs, n, found = [norm(v) for v in want], len(want), []
+            for i in cls._hits(lines, want[0], norm):
+                if i + n > len(lines) or [norm(v) for v in lines[i:i + n]] != xs: continue
+                found.append(i)
+                if len(found) > 1: return None
+            return (found[0] + 1, found[0] + n) if len(found) == 1 else None
 
-        return run(lambda s: s) or run(lambda s: (s or '').rstrip())
+        return run(cls._same) or run(cls._rstripped)
 
-    def _match_span(self, lines: list[str], blk: ReplaceBlock) -> tuple[int, int] | None:
+    def _match_span(self, lines: 'list[str] | TextDocument', blk: ReplaceBlock) -> tuple[int, int] | None:
         return self._find_replace_span(lines, blk.start1, blk.start2, blk.end) if blk.op == 'replace' and not blk.anchor else self._find_block_span(lines, blk.anchor)
 
     def _resolve_path(self, filename: str, ctx_files: list[str], create_if_missing: bool = False) -> str | None:
@@ -425,9 +1108,10 @@ class EditService:
 
     def _code_lang(self, rel: str) -> str: return LANG_BY_EXT.get(Path(rel).suffix.lower(), Path(rel).suffix.lower().lstrip('.'))
 
-    def render_edit_header(self, filename: str, blk: ReplaceBlock, ctx_files: list[str]) -> str | None:
-        rel = self._resolve_path(filename, ctx_files, create_if_missing=False)
-        if not rel or not (lines := self._read_file_lines(rel)) or not (span := self._match_span(lines, blk)): return None
+    def render_edit_header(self, filename: str, blk: ReplaceBlock, ctx_files: list[str], snapshots: 'SnapshotCache | None' = None) -> str | None:
+        rel = snapshots.resolve(filename, ctx_files) if snapshots else self._resolve_path(filename, ctx_files, create_if_missing=False)
+        lines = (snapshots.lines(rel) if snapshots else self._read_file_lines(rel)) if rel else None
+        if not lines or not (span := self._match_span(lines, blk)): return None
         a, b = span
         body, lang, tail = '\n'.join(lines[a - 1:b]), self._code_lang(rel), '#### WITH' if blk.op == 'replace' else '#### ADD'
         fence = f'```{lang}\n{body}\n```' if body else f'```{lang}\n```'
@@ -436,6 +1120,9 @@ class EditService:
     def new_display_renderer(self, ctx_files: list[str] | None = None) -> 'DisplayRenderer':
         return DisplayRenderer(self, ctx_files or [])
 
+    def new_edit_validator(self, ctx_files: list[str] | None = None) -> 'EditValidator':
+        return EditValidator(self, ctx_files or [])
+
     def _parse_section(self, filename: str, lines: list[str]) -> EditDirective | None:
         i = 0
         while i < len(lines) and not self._COMMAND_HDR_RE.match(lines[i]): i += 1
@@ -502,19 +1189,38 @@ class EditService:
         r = self.new_display_renderer(ctx_files or [])
         return r.feed(md or '') + r.finish()
 
+    def _plan_directive(self, d: EditDirective, ctx_files: list[str], written: dict[str, str]) -> PlannedEdit:
+        full_edit = d.full_new is not None and not d.replaces
+        rel = self._resolve_path(d.filename, ctx_files=[*written, *ctx_files], create_if_missing=full_edit)
+        if not rel: return PlannedEdit(d, error='Invalid path (must be relative to base dir)')
+        p = (self.base_dir / Path(rel)).resolve()
+        if not p.is_relative_to(self.base_dir): return PlannedEdit(d, rel, 'Path escapes base dir')
+        if full_edit or not d.replaces: return PlannedEdit(d, rel)
+        # No digest: apply_plan re-matches these against the staged Write, which these spans are only a preview of.
+        if rel in written: return PlannedEdit(d, rel, spans=[self._match_span(self._split_lines(self._norm_newlines(written[rel])), blk) for blk in d.replaces])
+        if not p.exists(): return PlannedEdit(d, rel)
+        try:
+            with TextDocument.open(p) as doc: return PlannedEdit(d, rel, digest=hashlib.blake2b(doc.data).hexdigest(), spans=[self._match_span(doc, blk) for blk in d.replaces])
+        except Exception as e:
+            return PlannedEdit(d, rel, f'Error: {e}')
+
+    def plan_edits(self, directives: list[EditDirective], ctx_files: list[str]) -> EditPlan:
+        """Resolve paths and match anchors once; apply_plan reuses the spans while the file's content hash is unchanged.
+        Directives after a full Write in the same plan resolve to the written file and are matched against its content."""
+        plan, written = EditPlan(ctx_files=list(ctx_files)), {}
+        for d in directives:
+            plan.edits.append(x := self._plan_directive(d, ctx_files, written))
+            if not x.error and d.full_new is not None and not d.replaces: written[x.rel] = d.full_new
+        return plan
+
     def apply_markdown_edits(self, md: str, assistant_id: str | None, ctx_files: list[str]) -> tuple[list[EditEvent], str]:
         directives = self.parse_edit_markdown(md)
-        if not directives: return [], ''
-        results, failed_cmds, tx = [], [], {'assistant_id': assistant_id, 'files': {}, 'changed': set()}
-
-        def abs_of(rel: str) -> Path: return (self.base_dir / Path(rel)).resolve()
+        return self.apply_plan(self.plan_edits(directives, ctx_files), assistant_id) if directives else ([], '')
 
-        def remember_prev(rel: str):
-            if rel in tx['files']: return
-            p = abs_of(rel)
-            tx['files'][rel] = p.read_text(encoding='utf-8') if p.exists() else None
+    def _stage_file(self, rel: str, items: list[tuple[int, PlannedEdit]]) -> StagedFile:
+        st = StagedFile(rel, (self.base_dir / Path(rel)).resolve())
 
-        def fmt_cmd(rel: str, blk: ReplaceBlock) -> str:
+        def fmt_cmd(blk: ReplaceBlock) -> str:
             if blk.op == 'replace': return f'{rel}: Replace `{blk.anchor}`' if blk.anchor else f'{rel}: Replace `{blk.start1}` + `{blk.start2}` ... `{blk.end}`'
             return f'{rel}: {self._LABELS[blk.op]} `{blk.anchor}`'
 
@@ -522,113 +1228,201 @@ class EditService:
             a, b = span
             return (a - 1, b) if op == 'replace' else (b, b) if op == 'insert_after' else (a - 1, a - 1)
 
-        def orig_loc(m: list[int | None], span: tuple[int, int], op: str) -> tuple[int, int, int, int] | None:
-            a, b = span
-            s, t = (a - 1, b) if op == 'replace' else (b, b) if op == 'insert_after' else (a - 1, a - 1)
-            i0, i1 = m[s], m[t]
+        def orig_loc(m: PositionMap, span: tuple[int, int], op: str) -> tuple[int, int, int, int] | None:
+            s, t = cur_loc(span, op)
+            i0, i1 = m.get(s), m.get(t)
             return None if i0 is None or i1 is None else (i0, i1, s, t)
 
-        def rebase(m: list[int | None], i0: int, i1: int, k: int, op: str, s: int | None = None, t: int | None = None):
-            d = k - (i1 - i0)
-            for j, v in enumerate(m):
-                if v is None: continue
-                if s is not None:
-                    if op == 'replace':
-                        if j < s: continue
-                        if j == s: m[j] = i0
-                        elif j == t: m[j] = i0 + k
-                        elif s < j < t: m[j] = None
-                        elif j > t and v >= i1: m[j] = v + d
-                    elif op == 'insert_before':
-                        if j >= s: m[j] = v + k
-                    elif j > t:
-                        m[j] = v + k
-                    continue
-                if op == 'replace':
-                    if i0 < v < i1: m[j] = None
-                    elif v == i1: m[j] = i0 + k
-                    elif v > i1: m[j] = v + d
-                elif op == 'insert_before':
-                    if v >= i0: m[j] = v + k
-                elif v > i0:
-                    m[j] = v + k
+        def stage(tmp: str):
+            if st.tmp:
+                with contextlib.suppress(OSError): os.unlink(st.tmp)
+            st.tmp = tmp
 
-        for d in directives:
-            try:
-                full_edit = d.full_new is not None and not d.replaces
-                rel = self._resolve_path(d.filename, ctx_files=ctx_files, create_if_missing=full_edit)
-                if not rel:
-                    results.append(EditEvent('error', Path(d.filename).name, 'Invalid path (must be relative to base dir)', d.filename))
-                    continue
-                p = abs_of(rel)
-                if not p.is_relative_to(self.base_dir):
-                    results.append(EditEvent('error', Path(rel).name, 'Path escapes base dir', rel))
-                    continue
-                if full_edit:
-                    original, updated_norm = p.read_text(encoding='utf-8') if p.exists() else None, self._norm_newlines(d.full_new or '')
+        name, i = Path(rel).name, -1
+        try:
+            for i, x in items:
+                d, src, exists = x.directive, Path(st.tmp) if st.tmp else st.path, bool(st.tmp) or st.path.exists()
+                if d.full_new is not None and not d.replaces:
+                    original, updated_norm = src.read_text(encoding='utf-8') if exists else None, self._norm_newlines(d.full_new or '')
                     updated = updated_norm if original is None or '\r\n' not in original else updated_norm.replace('\n', '\r\n')
                     if original is not None and updated == original:
-                        results.append(EditEvent('error', Path(rel).name, 'No changes applied', rel))
+                        st.events.append((i, EditEvent('error', name, 'No changes applied', rel)))
                         continue
-                    remember_prev(rel)
-                    self._atomic_write(p, updated)
-                    tx['changed'].add(rel)
-                    results.append(EditEvent('complete', Path(rel).name, f'full rewrite: {self._count_lines_norm(original or "")} → {self._count_lines_norm(updated)} lines', rel))
+                    st.runs = []
+                    stage(self._write_temp(st.path, updated))
+                    st.events.append((i, EditEvent('complete', name, f'full rewrite: {self._count_lines_norm(original or "")} → {self._count_lines_norm(updated)} lines', rel)))
                     continue
-                if not p.exists():
-                    results.append(EditEvent('error', Path(rel).name, 'File does not exist', rel))
+                if not exists:
+                    st.events.append((i, EditEvent('error', name, 'File does not exist', rel)))
                     continue
                 if not d.replaces:
-                    results.append(EditEvent('error', Path(rel).name, 'No edit blocks found', rel))
+                    st.events.append((i, EditEvent('error', name, 'No edit blocks found', rel)))
                     continue
 
-                original = p.read_text(encoding='utf-8')
-                eol, norm, had_final_nl = ('\r\n' if '\r\n' in original else '\n'), self._norm_newlines(original), self._norm_newlines(original).endswith('\n')
-                lines = norm.split('\n')
-                if had_final_nl: lines = lines[:-1]
-
-                updated_lines, applied, failed_here, orig_pos = lines[:], 0, [], list(range(len(lines) + 1))
-                for blk in d.replaces:
-                    new_norm = self._norm_newlines(blk.new).rstrip('\n')
-                    new_lines = [] if new_norm == '' else new_norm.split('\n')
-                    if (span := self._match_span(lines, blk)) and (loc := orig_loc(orig_pos, span, blk.op)):
-                        i0, i1, s, t = loc
-                        from_orig = True
-                    elif span := self._match_span(updated_lines, blk):
-                        i0, i1 = cur_loc(span, blk.op)
-                        from_orig = False
-                    else:
-                        failed_here.append(blk)
+                with TextDocument.open(src) as doc:
+                    lines, applied, failed_here, orig_pos = doc.original(), 0, [], PositionMap(len(doc))
+                    spans = x.spans if not st.tmp and x.digest == hashlib.blake2b(doc.data).hexdigest() else [self._match_span(lines, blk) for blk in d.replaces]
+                    for blk, span in zip(d.replaces, spans):
+                        new_norm = self._norm_newlines(blk.new).rstrip('\n')
+                        new_lines = [] if new_norm == '' else new_norm.split('\n')
+                        if span and (loc := orig_loc(orig_pos, span, blk.op)):
+                            i0, i1, s, t = loc
+                        elif span := self._match_span(doc, blk):
+                            (i0, i1), s, t = cur_loc(span, blk.op), None, None
+                        else:
+                            failed_here.append(blk)
+                            continue
+                        applied += doc.splice(i0, i1, new_lines)
+                        orig_pos.splice(i0, i1, len(new_lines), blk.op, s, t)
+                    st.failed.extend(fmt_cmd(blk) for blk in failed_here)
+                    if doc.unchanged():
+                        st.events.append((i, EditEvent('error', name, 'No changes applied', rel)))
                         continue
-                    next_lines = updated_lines[:]
-                    next_lines[i0:i1] = new_lines
-                    if next_lines != updated_lines: applied += 1
-                    updated_lines = next_lines
-                    rebase(orig_pos, i0, i1, len(new_lines), blk.op, s, t) if from_orig else rebase(orig_pos, i0, i1, len(new_lines), blk.op)
-
-                updated_norm = '\n'.join(updated_lines) + ('\n' if had_final_nl else '')
-                updated = updated_norm if eol == '\n' else updated_norm.replace('\n', '\r\n')
-                if updated == original:
-                    for blk in failed_here: failed_cmds.append(fmt_cmd(rel, blk))
-                    results.append(EditEvent('error', Path(rel).name, 'No changes applied', rel))
+                    n0, n1, tmp = lines.count_lines(), doc.count_lines(), self._write_temp(st.path, doc.chunks(), newline='')
+                    st.runs = self._compose_runs(doc.runs(), st.runs) if st.tmp else doc.runs()
+                stage(tmp)
+                st.events.append((i, EditEvent('partial' if failed_here else 'complete', name, f'applied {applied} edit(s)' + (f', {len(failed_here)} failed' if failed_here else '') + f': {n0} → {n1} lines', rel)))
+            if st.tmp: st.undo = self._undo_record(st)
+        except Exception as e:
+            st.discard()
+            st.error = (i, f'Error: {e}')
+        return st
+
+    @staticmethod
+    def _compose_runs(outer: list[tuple[int, int, int]], inner: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        # outer maps current lines onto the previous staged file, inner maps that file onto the original.
+        starts, out = [r[0] for r in inner], []
+        for k, o, n in outer:
+            i = max(0, bisect.bisect_right(starts, o) - 1)
+            while n > 0 and i < len(inner):
+                s, t, m = inner[i]
+                if o >= s + m:
+                    i += 1
                     continue
+                c = min(n, s + m - o) if o >= s else min(n, s - o)
+                if o >= s: out.append((k, t + o - s, c))
+                k, o, n = k + c, o + c, n - c
+        return out
 
-                remember_prev(rel)
-                self._atomic_write(p, updated)
-                tx['changed'].add(rel)
-                for blk in failed_here: failed_cmds.append(fmt_cmd(rel, blk))
-                results.append(EditEvent('partial' if failed_here else 'complete', Path(rel).name, f'applied {applied} edit(s)' + (f', {len(failed_here)} failed' if failed_here else '') + f': {self._count_lines_norm(original)} → {self._count_lines_norm(updated)} lines', rel))
-            except Exception as e:
-                results.append(EditEvent('error', Path(d.filename).name, f'Error: {e}', d.filename))
+    @staticmethod
+    def _reverse_hunks(old: TextDocument, new: TextDocument, runs: list[tuple[int, int, int]]) -> Iterator[tuple[int, int, bytes]]:
+        """(start, end, original bytes) spans of the new file; runs are only hints since kept lines are compared byte for byte."""
+        def seg(d: TextDocument, i: int) -> int: return d.starts[i] if i < len(d.starts) else len(d.data)
+        j, pos, nn, no = 0, 0, len(new.starts), len(old.starts)
+
+        def keep(k: int, o: int, n: int) -> Iterator[tuple[int, int, bytes]]:
+            nonlocal j, pos
+            if seg(new, k) > pos or seg(old, o) > seg(old, j): yield pos, seg(new, k), old.data[seg(old, j):seg(old, o)]
+            j, pos = o + n, seg(new, k + n)
+
+        for k, o, n in runs:
+            if seg(new, k) < pos or o < j: continue
+            n = min(n, nn - k, no - o)
+            if n <= 0: continue
+            if new.data[seg(new, k):seg(new, k + n)] == old.data[seg(old, o):seg(old, o + n)]:
+                yield from keep(k, o, n)
+                continue
+            for t in range(n):
+                if new.data[seg(new, k + t):seg(new, k + t + 1)] == old.data[seg(old, o + t):seg(old, o + t + 1)]: yield from keep(k + t, o + t, 1)
+        if pos < len(new.data) or seg(old, j) < len(old.data): yield pos, len(new.data), old.data[seg(old, j):]
+
+    def _undo_record(self, st: StagedFile) -> tuple[str, str, bytes]:
+        with TextDocument.open(Path(st.tmp)) as new:
+            after = hashlib.blake2b(new.data).hexdigest()
+            if not st.path.exists(): return 'absent', after, b''
+            with TextDocument.open(st.path) as old: return 'diff', after, UndoJournal.pack(self._reverse_hunks(old, new, st.runs))
+
+    def _restore(self, tx: dict[str, Any], rel: str) -> bool:
+        """Undo `tx` for one file; False, leaving the file alone, if it no longer holds what the edit wrote."""
+        p = (self.base_dir / Path(rel)).resolve()
+        if not p.is_relative_to(self.base_dir): raise RuntimeError(f'Path escapes base dir: {rel}')
+        kind, after, hunks = self.journal.read(tx, rel)
+        if not p.exists(): return kind == 'absent'
+        with open(p, 'rb') as f:
+            cur = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        try:
+            if hashlib.blake2b(cur).hexdigest() != after: return False
+            if kind == 'absent':
+                p.unlink()
+                return True
+
+            def parts() -> Iterator[bytes]:
+                pos = 0
+                for a, b, x in hunks:
+                    yield cur[pos:a]
+                    yield x
+                    pos = b
+                yield cur[pos:]
+            self._atomic_write(p, parts(), binary=True)
+            return True
+        finally:
+            if isinstance(cur, mmap.mmap): cur.close()
+
+    @staticmethod
+    def _fsync_dirs(dirs: Iterable[Path]):
+        for d in dirs:
+            with contextlib.suppress(OSError):
+                fd = os.open(str(d), os.O_RDONLY)
+                try: os.fsync(fd)
+                finally: os.close(fd)
+
+    def _commit(self, groups: dict[str, list[tuple[int, PlannedEdit]]], assistant_id: str | None, progress: Callable[[EditEvent], None] | None) -> tuple[list[StagedFile], list[StagedFile], tuple[int, str] | None]:
+        def report(st: StagedFile) -> StagedFile:
+            if progress and st.tmp: progress(EditEvent('staged', Path(st.rel).name, '', st.rel))
+            return st
+
+        # Phase 1: build and fsync every temp file in parallel; nothing on disk is touched yet.
+        if len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=min(self._STAGE_WORKERS, len(groups))) as pool:
+                futs = [pool.submit(self._stage_file, *kv) for kv in groups.items()]
+                for f in as_completed(futs): report(f.result())
+            staged = [f.result() for f in futs]
+        else:
+            staged = [report(self._stage_file(*kv)) for kv in groups.items()]
 
-        if tx['changed']:
-            tx['files'] = {p: tx['files'][p] for p in tx['changed']}
-            self.transactions.append(tx)
-            for p in tx['changed']: self.edited_files[p] = True
+        # Phase 2: rename everything, or restore what was already renamed if a rename fails.
+        # The undo record is journaled before any rename so a crash mid-commit can still be rolled back.
+        abort, done, tx = next((st.error for st in staged if st.error), None), [], None
+        if not abort and (ready := [st for st in staged if st.tmp]):
+            try:
+                tx = self.journal.append(assistant_id, [(st.rel, *st.undo) for st in ready])
+                for st in ready:
+                    os.replace(st.tmp, str(st.path))
+                    st.tmp = None
+                    done.append(st)
+            except Exception as e:
+                abort = (-1, f'Error: {e}')
+                for st in reversed(done):
+                    with contextlib.suppress(Exception): self._restore(tx, st.rel)
+                if tx:
+                    with contextlib.suppress(Exception): self.journal.drop(tx, tx['changed'])
+                done = []
+        if abort:
+            for st in staged: st.discard()
+        self._fsync_dirs({st.path.parent for st in done})
+        return staged, done, abort
+
+    def apply_plan(self, plan: EditPlan, assistant_id: str | None, progress: Callable[[EditEvent], None] | None = None) -> tuple[list[EditEvent], str]:
+        if not plan.edits: return [], ''
+        events: list[EditEvent | None] = [None] * len(plan.edits)
+        groups: dict[str, list[tuple[int, PlannedEdit]]] = {}
+        for i, x in enumerate(plan.edits):
+            if x.error: events[i] = EditEvent('error', Path(x.rel or x.directive.filename).name, x.error, x.rel or x.directive.filename)
+            else: groups.setdefault(x.rel, []).append((i, x))
+
+        with PATH_LOCKS.hold((self.base_dir / Path(rel)).resolve() for rel in groups): staged, done, abort = self._commit(groups, assistant_id, progress)
+
+        failed_cmds = [c for st in staged for c in st.failed]
+        for st in staged:
+            for i, ev in st.events: events[i] = ev if not abort or ev.kind == 'error' else EditEvent('error', ev.filename, 'Not applied: edit round aborted', ev.path)
+            if st.error and st.error[0] >= 0: events[st.error[0]] = EditEvent('error', Path(st.rel).name, st.error[1], st.rel)
+        if abort and abort[0] < 0: events.append(EditEvent('error', 'edits', abort[1]))
+
+        for st in done: self.edited_files[st.rel] = True
 
         uniq = list(dict.fromkeys(failed_cmds))
-        prefill = ('Some edits were applied, but the following commands failed:' if tx['changed'] else 'No edits were applied; the following commands failed:') + '\n' + '\n'.join(f'- {c}' for c in uniq) + '\n\nPlease generate corrected versions.' if uniq else ''
-        return results, prefill
+        prefill = ('Some edits were applied, but the following commands failed:' if done else 'No edits were applied; the following commands failed:') + '\n' + '\n'.join(f'- {c}' for c in uniq) + '\n\nPlease generate corrected versions.' if uniq else ''
+        return [ev for ev in events if ev], prefill
 
     def _rebuild_edited_files(self):
         self.edited_files = {p: True for t in self.transactions if isinstance(self.transactions, list) for p in t.get('changed', set())}
@@ -636,88 +1430,193 @@ class EditService:
     def rollback_file(self, file_path: str) -> bool:
         rel = (file_path or '').strip().replace('\\', '/')
         if not rel or Path(rel).is_absolute(): return False
-        p, txs = (self.base_dir / Path(rel)).resolve(), self.transactions if isinstance(self.transactions, list) else []
-        if not p.is_relative_to(self.base_dir): return False
-        for i in range(len(txs) - 1, -1, -1):
-            tx, changed = txs[i], txs[i].get('changed', set())
-            if rel not in changed: continue
-            prev = tx.get('files', {}).get(rel, None)
-            try:
-                if prev is None:
-                    with contextlib.suppress(FileNotFoundError): p.unlink()
-                else:
-                    self._atomic_write(p, prev)
-            except Exception:
-                return False
-            changed.remove(rel)
-            tx.get('files', {}).pop(rel, None)
-            if not changed: txs.pop(i)
-            self._rebuild_edited_files()
-            return True
+        if not (self.base_dir / Path(rel)).resolve().is_relative_to(self.base_dir): return False
+        with PATH_LOCKS.hold([(self.base_dir / Path(rel)).resolve()]):
+            for tx in reversed(self.transactions):
+                if rel not in tx['changed']: continue
+                try: self._restore(tx, rel)
+                except Exception:
+                    return False
+                self.journal.drop(tx, [rel])
+                self._rebuild_edited_files()
+                return True
         return False
 
-    def rollback_for_assistant(self, assistant_id: str) -> bool:
+    def rollback_for_assistant(self, assistant_id: str) -> list[str]:
+        """Undo the edits of `assistant_id`'s turn; returns the files left alone because they changed (or were deleted) since."""
         txs, j = self.transactions if isinstance(self.transactions, list) else [], len(self.transactions if isinstance(self.transactions, list) else [])
         while j and txs[j - 1].get('assistant_id') == assistant_id: j -= 1
-        if j == len(txs): return True
+        if j == len(txs): return []
+        with PATH_LOCKS.hold((self.base_dir / Path(rel)).resolve() for tx in txs[j:] for rel in tx['changed']): return self._rollback_txs(txs[j:], assistant_id)
 
-        snapshot, restored = {}, []
+    def _rollback_txs(self, txs: list[dict[str, Any]], assistant_id: str) -> list[str]:
+        snapshot, restored, skipped = {}, [], set()
         try:
-            for tx in reversed(txs[j:]):
-                for rel in list(tx.get('changed', set())):
+            for tx in reversed(txs):
+                for rel in list(tx['changed']):
                     p = (self.base_dir / Path(rel)).resolve()
                     if not p.is_relative_to(self.base_dir): raise RuntimeError(f'Path escapes base dir: {rel}')
-                    if rel not in snapshot: snapshot[rel] = p.read_text(encoding='utf-8') if p.exists() else None
-                    prev = tx.get('files', {}).get(rel, None)
-                    if prev is None:
-                        with contextlib.suppress(FileNotFoundError): p.unlink()
-                    else:
-                        self._atomic_write(p, prev)
+                    if rel in skipped: continue  # older rounds of a skipped file would apply to content it no longer has
+                    if rel not in snapshot: snapshot[rel] = p.read_bytes() if p.exists() else None
+                    if not self._restore(tx, rel):
+                        skipped.add(rel)
+                        continue
                     restored.append(rel)
         except Exception as e:
             try:
                 for rel in dict.fromkeys(reversed(restored)):
                     p, cur = (self.base_dir / Path(rel)).resolve(), snapshot[rel]
-                    if not p.is_relative_to(self.base_dir): raise RuntimeError(f'Path escapes base dir during recovery: {rel}')
                     if cur is None:
                         with contextlib.suppress(FileNotFoundError): p.unlink()
                     else:
-                        self._atomic_write(p, cur)
+                        self._atomic_write(p, cur, binary=True)
             except Exception as e2:
                 raise RuntimeError(f'Rollback failed for assistant {assistant_id}: {e}; recovery failed: {e2}') from e2
             raise RuntimeError(f'Rollback failed for assistant {assistant_id}: {e}') from e
 
-        del txs[j:]
+        for tx in txs: self.journal.drop(tx, tx['changed'])
         self._rebuild_edited_files()
-        return True
+        return sorted(skipped)
+
+
+class Snapshot(list):
+    """Split file lines plus, per anchor normalization, the positions of each distinct line."""
+
+    def __init__(self, lines: Iterable[str], norms: Iterable[Any] = ()):
+        super().__init__(lines)
+        self.index: dict[Any, dict[str, list[int]]] = {}
+        for norm in norms: self._index(norm)
+
+    def _index(self, norm) -> dict[str, list[int]]:
+        if (idx := self.index.get(norm)) is None:
+            idx = self.index[norm] = {}
+            for i, v in enumerate(self): idx.setdefault(norm(v), []).append(i)
+        return idx
+
+    def hits(self, x: str, norm, start: int = 0) -> Iterator[int]:
+        xs = self._index(norm).get(norm(x), [])
+        return iter(xs[bisect.bisect_left(xs, start):])
+
+
+class SnapshotCache:
+    """Split lines of files under the service's base dir, reused until a file's mtime or size changes, plus resolved edit paths."""
+
+    def __init__(self, service: EditService):
+        self.service = service
+        self.items: dict[str, tuple[tuple[int, int], Snapshot]] = {}
+        self.paths: dict[str, str | None] = {}
+
+    def resolve(self, filename: str, ctx_files: list[str]) -> str | None:
+        if filename not in self.paths: self.paths[filename] = self.service._resolve_path(filename, ctx_files)
+        return self.paths[filename]
+
+    def lines(self, rel: str) -> Snapshot | None:
+        p = (self.service.base_dir / Path(rel)).resolve()
+        if not p.is_relative_to(self.service.base_dir): return None
+        try: st = p.stat()
+        except OSError: return None
+        key = (st.st_mtime_ns, st.st_size)
+        if (hit := self.items.get(rel)) and hit[0] == key: return hit[1]
+        if (lines := self.service._read_file_lines(rel)) is None: return None
+        self.items[rel] = (key, snap := Snapshot(lines, (EditService._same, EditService._rstripped)))
+        return snap
+
+
+class EditValidator:
+    """Incremental directive parser for a streaming response: each command is checked against a file snapshot as soon as its fence closes."""
+
+    def __init__(self, service: EditService, ctx_files: list[str]):
+        self.service = service
+        self.ctx_files = [p for p in ctx_files if p]
+        self.snapshots = SnapshotCache(service)
+        self.current_file = ''
+        self.section: list[str] = []
+        self.cmd_start: int | None = None
+        self.in_fence = False
+        self.parts: list[str] = []
+        self.cr = False
+        self.total = 0
+        self.resolved = 0
+
+    def _line(self, line: str) -> list[tuple[str, ReplaceBlock]]:
+        s = self.service
+        if m := s._EDIT_HDR_RE.match(line):
+            self.current_file, self.section, self.cmd_start, self.in_fence = (m.group(1) or '').strip().replace('`', ''), [], None, False
+            return []
+        if not self.current_file: return []
+        self.section.append(line)
+        if self.in_fence:
+            if not s._FENCE_CLOSE_RE.match(line): return []
+            self.in_fence = False
+            if self.cmd_start is None: return []
+            d, self.cmd_start = s._parse_section(self.current_file, self.section[self.cmd_start:]), None
+            return [(self.current_file, blk) for blk in (d.replaces if d else [])]
+        if s._COMMAND_HDR_RE.match(line): self.cmd_start = len(self.section) - 1
+        elif s._FENCE_OPEN_RE.match(line): self.in_fence = True
+        return []
+
+    def feed(self, chunk: str) -> list[tuple[str, ReplaceBlock]]:
+        """Consume a stream chunk; returns the commands completed by it."""
+        if not chunk: return []
+        if self.cr and chunk.startswith('\n'): chunk = chunk[1:]
+        self.cr, out = chunk.endswith('\r'), []
+        *done, tail = self.service._norm_newlines(chunk).split('\n')
+        for piece in done:
+            self.parts.append(piece)
+            line, self.parts = ''.join(self.parts), []
+            out += self._line(line)
+        if tail: self.parts.append(tail)
+        return out
+
+    def finish(self) -> list[tuple[str, ReplaceBlock]]:
+        line, self.parts = ''.join(self.parts), []
+        return self._line(line) if line else []
+
+    def check(self, blocks: list[tuple[str, ReplaceBlock]]) -> tuple[int, int]:
+        """Resolve anchors of completed commands against cached snapshots; blocking, meant for a worker thread."""
+        for filename, blk in blocks:
+            rel = self.snapshots.resolve(filename, self.ctx_files)
+            lines = self.snapshots.lines(rel) if rel else None
+            self.total, self.resolved = self.total + 1, self.resolved + bool(lines and self.service._match_span(lines, blk))
+        return self.resolved, self.total
 
 
 class DisplayRenderer:
+    """Single-pass streaming renderer: the open line is kept as a chunk list and every completed line is classified by one regex match."""
+    _LINE_RE = re.compile(r'^\s*(?:(?P<close>```\s*$)|(?P<open>```[ \t]*[^\n`]*\s*$)|(?i:###\s*Edit\s+(?P<file>.+?)\s*$)|(?i:####\s*(?P<cmd>Replace|Insert After|Insert Before|Write)\s*$)|(?P<key>StartAnchor1|StartAnchor2|EndAnchor|Anchor)\|(?P<val>.*)$)')
+
     def __init__(self, service: EditService, ctx_files: list[str]):
         self.service = service
         self.ctx_files = [p for p in ctx_files if p]
+        self.snapshots = SnapshotCache(service)
         self.current_file = ''
         self.cmd: DisplayCommandState | None = None
         self.in_fence = False
-        self.tail = ''
-        self.tail_emitted = 0
+        self.parts: list[str] = []
+        self.sent = 0
+        self.emitted = 0
+        self.lead: str | None = None
+        self.live = False
+        self.cr = False
+
+    def _streams(self) -> bool:
+        # Whether the open line can be shown before it completes; lines that may still turn into edit headers are held.
+        if self.cmd: return self.cmd.phase == 'stream_new'
+        return self.in_fence or self.lead is not None and self.lead != '#'
+
+    def _partial(self, frag: str) -> str:
+        self.parts.append(frag)
+        if self.lead is None and (t := frag.lstrip()): self.lead = t[0]
+        self.live = self.live or self._streams()
+        if not self.live: return ''
+        out, self.sent = ''.join(self.parts[self.sent:]), len(self.parts)
+        self.emitted += len(out)
+        return out
 
-    @staticmethod
-    def _candidate_mode(s: str) -> str:
-        t = s.lstrip()
-        return 'unknown' if t == '' else 'header' if t.startswith('#') else 'fence' if t.startswith('```') else 'ordinary'
-
-    def _streaming_command_fence(self) -> bool:
-        return self.cmd is not None and self.cmd.phase == 'stream_new'
-
-    def _append_partial(self, frag: str) -> str:
-        if not frag: return ''
-        self.tail += frag
-        if self.in_fence or self._streaming_command_fence() or (self.cmd is None and self._candidate_mode(self.tail) == 'ordinary'):
-            out = self.tail[self.tail_emitted:]
-            self.tail_emitted = len(self.tail)
-            return out
-        return ''
+    def _take_line(self, rest: str) -> tuple[str, int]:
+        line, emitted = ''.join(self.parts) + rest if self.parts else rest, self.emitted
+        self.parts, self.sent, self.emitted, self.lead, self.live = [], 0, 0, None, False
+        return line, emitted
 
     @staticmethod
     def _join_raw(lines: list[str], final_newline: bool) -> str:
@@ -731,102 +1630,89 @@ class DisplayRenderer:
         if not self.cmd: return ''
         c = self.cmd
         blk = ReplaceBlock(op=c.op, start1=c.start1, start2=c.start2, end=c.end, anchor=c.anchor)
-        if not (text := self.service.render_edit_header(c.filename, blk, self.ctx_files)): return self._flush_raw(True)
+        if not (text := self.service.render_edit_header(c.filename, blk, self.ctx_files, self.snapshots)): return self._flush_raw(True)
         c.raw, c.phase = [], 'new_fence'
         return text + '\n'
 
-    def _begin_command(self, line: str) -> str:
-        if not self.current_file or not (m := self.service._COMMAND_HDR_RE.match(line)): return line + '\n'
-        op = self.service._OPS[m.group(1).strip().lower()]
+    def _begin_command(self, line: str, m: re.Match | None) -> str:
+        if not self.current_file or not m or m['cmd'] is None: return line + '\n'
+        op = self.service._OPS[m['cmd'].strip().lower()]
         if op == 'write': return line + '\n'
         self.cmd = DisplayCommandState(op=op, filename=self.current_file, phase='start1' if op == 'replace' else 'anchor', raw=[line])
         return ''
 
-    def _finish_command_line(self, line: str, emitted: int = 0) -> str:
-        if not self.cmd: return line + '\n'
-        c = self.cmd
+    def _command_line(self, line: str, m: re.Match | None, emitted: int) -> str:
+        c, key = self.cmd, m['key'] if m else None
         if c.phase == 'stream_new':
-            if self.service._FENCE_CLOSE_RE.match(line): self.cmd = None
+            if m and m['close'] is not None: self.cmd = None
             return line[emitted:] + '\n'
         c.raw.append(line)
-        if c.op == 'replace':
-            if c.phase == 'start1':
-                if line.strip() == '': return ''
-                if not (m := self.service._KEY_RE.match(line)): return self._flush_raw(True)
-                if m.group(1) == 'Anchor' and m.group(2) != '':
-                    c.anchor = m.group(2)
-                    return self._render()
-                if m.group(1) != 'StartAnchor1': return self._flush_raw(True)
-                c.start1, c.phase = m.group(2), 'start2'
-                return ''
-            if c.phase == 'start2':
-                if line.strip() == '': return ''
-                if not (m := self.service._KEY_RE.match(line)) or m.group(1) != 'StartAnchor2': return self._flush_raw(True)
-                c.start2, c.phase = m.group(2), 'end'
-                return ''
-            if c.phase == 'end':
-                if line.strip() == '': return ''
-                if not (m := self.service._KEY_RE.match(line)) or m.group(1) != 'EndAnchor': return self._flush_raw(True)
-                c.end = m.group(2)
-                return self._render()
-        else:
-            if c.phase == 'anchor':
-                if line.strip() == '': return ''
-                if not (m := self.service._KEY_RE.match(line)) or m.group(1) != 'Anchor' or m.group(2) == '': return self._flush_raw(True)
-                c.anchor = m.group(2)
+        if c.phase in ('start1', 'start2', 'end', 'anchor') and line.strip() == '': return ''
+        if c.phase == 'start1':
+            if key == 'Anchor' and m['val'] != '':
+                c.anchor = m['val']
                 return self._render()
+            if key != 'StartAnchor1': return self._flush_raw(True)
+            c.start1, c.phase = m['val'], 'start2'
+            return ''
+        if c.phase == 'start2':
+            if key != 'StartAnchor2': return self._flush_raw(True)
+            c.start2, c.phase = m['val'], 'end'
+            return ''
+        if c.phase == 'end':
+            if key != 'EndAnchor': return self._flush_raw(True)
+            c.end = m['val']
+            return self._render()
+        if c.phase == 'anchor':
+            if key != 'Anchor' or m['val'] == '': return self._flush_raw(True)
+            c.anchor = m['val']
+            return self._render()
         if c.phase == 'new_fence':
             if line.strip() == '': return ''
-            if self.service._FENCE_OPEN_RE.match(line):
+            if m and (m['open'] is not None or m['close'] is not None):
                 c.raw, c.phase = [], 'stream_new'
                 return line + '\n'
-            self.cmd = None
-            return line + '\n'
         self.cmd = None
         return line + '\n'
 
-    def _finish_complete_line(self) -> str:
-        line, emitted = self.tail, self.tail_emitted
-        self.tail, self.tail_emitted = '', 0
-        if self.cmd: return self._finish_command_line(line, emitted)
+    def _line(self, line: str, emitted: int) -> str:
+        m = self._LINE_RE.match(line)
+        if self.cmd: return self._command_line(line, m, emitted)
         if self.in_fence:
-            if self.service._FENCE_CLOSE_RE.match(line): self.in_fence = False
+            if m and m['close'] is not None: self.in_fence = False
             return line[emitted:] + '\n'
-        if m := self.service._EDIT_HDR_RE.match(line):
-            self.current_file = (m.group(1) or '').strip().replace('`', '')
+        if m and m['file'] is not None:
+            self.current_file = m['file'].strip().replace('`', '')
             return line[emitted:] + '\n'
-        if self.service._FENCE_OPEN_RE.match(line):
+        if m and (m['open'] is not None or m['close'] is not None):
             self.in_fence = True
             return line[emitted:] + '\n'
-        return self._begin_command(line) if emitted == 0 else line[emitted:] + '\n'
-
-    def _finish_tail(self) -> str:
-        line, emitted = self.tail, self.tail_emitted
-        self.tail, self.tail_emitted = '', 0
-        if line == '': return self._flush_raw(False) if self.cmd and self.cmd.raw else ''
-        if self.cmd:
-            if self._streaming_command_fence(): return line[emitted:]
-            self.cmd.raw.append(line)
-            return self._flush_raw(False)
-        if self.in_fence: return line[emitted:]
-        if m := self.service._EDIT_HDR_RE.match(line):
-            self.current_file = (m.group(1) or '').strip().replace('`', '')
-            return line[emitted:] if emitted else line
-        return line[emitted:] if emitted else line
+        return self._begin_command(line, m) if emitted == 0 else line[emitted:] + '\n'
 
     def feed(self, chunk: str) -> str:
         if not chunk: return ''
-        data, out = self.service._norm_newlines(chunk), []
-        while True:
-            i = data.find('\n')
-            if i < 0:
-                if tail := self._append_partial(data): out.append(tail)
-                break
-            self.tail, data = self.tail + data[:i], data[i + 1:]
-            out.append(self._finish_complete_line())
+        if self.live and not self.cr and '\n' not in chunk and '\r' not in chunk:
+            self.parts.append(chunk)
+            self.sent, self.emitted = self.sent + 1, self.emitted + len(chunk)
+            return chunk
+        if self.cr and chunk[0] == '\n': chunk = chunk[1:]
+        self.cr = chunk.endswith('\r')
+        data, out, pos = self.service._norm_newlines(chunk) if '\r' in chunk else chunk, [], 0
+        while (i := data.find('\n', pos)) >= 0:
+            out.append(self._line(*self._take_line(data[pos:i])))
+            pos = i + 1
+        if pos < len(data) and (x := self._partial(data[pos:] if pos else data)): out.append(x)
         return ''.join(out)
 
-    def finish(self) -> str: return self._finish_tail()
+    def finish(self) -> str:
+        line, emitted = self._take_line('')
+        if line == '': return self._flush_raw(False) if self.cmd and self.cmd.raw else ''
+        if self.cmd:
+            if self.cmd.phase == 'stream_new': return line[emitted:]
+            self.cmd.raw.append(line)
+            return self._flush_raw(False)
+        if not self.in_fence and (m := self._LINE_RE.match(line)) and m['file'] is not None: self.current_file = m['file'].strip().replace('`', '')
+        return line[emitted:]
 
 
 class PromptBuilder:
@@ -900,6 +1786,14 @@ class ChatClient:
         self.edit_transactions = self.edit_service.transactions
         self._user_input_prefill = ''
 
+    def open_journal(self, journal_id: str):
+        journal = UndoJournal.open(UNDO_DIR / f'{journal_id}.log')  # raises before the current journal is let go
+        self.edit_service.journal.release()
+        self.edit_service.attach_journal(journal)
+        self.edited_files, self.edit_transactions = self.edit_service.edited_files, self.edit_service.transactions
+
+    def close(self): self.edit_service.journal.release()
+
     def get_completion(self, data: dict[str, Any]):
         return self.client.chat.completions.create(**data)
 
@@ -918,18 +1812,32 @@ class ChatClient:
     def new_display_renderer(self, ctx_files: list[str] | None = None) -> DisplayRenderer:
         return self.edit_service.new_display_renderer(ctx_files or [])
 
+    def new_edit_validator(self, ctx_files: list[str] | None = None) -> EditValidator:
+        return self.edit_service.new_edit_validator(ctx_files or [])
+
     def render_for_display(self, md: str, ctx_files: list[str] | None = None) -> str:
         return self.edit_service.render_for_display(md, ctx_files or [])
 
     def parse_edit_markdown(self, md: str) -> list[EditDirective]:
         return self.edit_service.parse_edit_markdown(md)
 
+    def plan_edits(self, directives: list[EditDirective], ctx_files: list[str]) -> EditPlan:
+        return self.edit_service.plan_edits(directives, ctx_files)
+
     def apply_markdown_edits(self, md: str, assistant_id: str, ctx_files: list[str]) -> list[EditEvent]:
         events, prefill = self.edit_service.apply_markdown_edits(md, assistant_id, ctx_files)
         self.edited_files, self.edit_transactions = self.edit_service.edited_files, self.edit_service.transactions
         if prefill: self._user_input_prefill = prefill
         return events
 
+    async def apply_edit_plan(self, plan: EditPlan, assistant_id: str, progress: Callable[[EditEvent], None] | None = None) -> list[EditEvent]:
+        loop = asyncio.get_running_loop()
+        report = (lambda ev: loop.call_soon_threadsafe(progress, ev)) if progress else None
+        events, prefill = await loop.run_in_executor(EDIT_POOL, self.edit_service.apply_plan, plan, assistant_id, report)
+        self.edited_files, self.edit_transactions = self.edit_service.edited_files, self.edit_service.transactions
+        if prefill: self._user_input_prefill = prefill
+        return events
+
     def consume_user_input_prefill(self) -> str:
         s, self._user_input_prefill = self._user_input_prefill, ''
         return s
@@ -939,10 +1847,10 @@ class ChatClient:
         self.edited_files, self.edit_transactions = self.edit_service.edited_files, self.edit_service.transactions
         return ok
 
-    def rollback_edits_for_assistant(self, assistant_id: str) -> bool:
-        ok = self.edit_service.rollback_for_assistant(assistant_id)
+    async def rollback_edits_for_assistant(self, assistant_id: str) -> list[str]:
+        skipped = await asyncio.get_running_loop().run_in_executor(EDIT_POOL, self.edit_service.rollback_for_assistant, assistant_id)
         self.edited_files, self.edit_transactions = self.edit_service.edited_files, self.edit_service.transactions
-        return ok
+        return skipped
 
     @staticmethod
     def _reasoning_options(model: str, reasoning: str) -> dict[str, Any]:
@@ -954,8 +1862,6 @@ class ChatClient:
         data = {'model': model, 'messages': messages, 'max_tokens': 50000, 'temperature': 0.6, 'stream': True, **self._reasoning_options(model, reasoning)}
 
         async def gen():
-            full = ''
-
             def pick(obj, key): return obj.get(key) if isinstance(obj, dict) else getattr(obj, key, None)
 
             try:
@@ -965,9 +1871,7 @@ class ChatClient:
                     if not choice: continue
                     delta = pick(choice, 'delta') or {}
                     text = pick(delta, 'content')
-                    if text:
-                        full += text
-                        yield text
+                    if text: yield text
                     r = pick(delta, 'reasoning')
                     reason = pick(r, 'content') if not isinstance(r, str) else r
                     if reason: yield ReasoningEvent(text=reason)
@@ -1,9 +1,27 @@
 (() => {
   if (window.chat7) return;
-  const esc = s => (s || '').replace(/[&<>"]/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;'}[c]));
-  const safe = t => { const n = ((t || '').match(/^\s*```/gm) || []).length; return n % 2 ? (t.endsWith('\n') ? t + '```' : t + '\n```') : (t || ''); };
   const el = id => document.getElementById(id);
-  const withNode = (id, f, n=40) => { const node = el(id); if (node) return f(node); if (n > 0) setTimeout(() => withNode(id, f, n - 1), 25); };
+  const pick = (nodes, sel) => nodes.flatMap(n => n instanceof Element ? [...(n.matches(sel) ? [n] : []), ...n.querySelectorAll(sel)] : []);
+  // Calls for a node the server has only just created wait for it to reach the DOM: one observer wakes them all (in
+  // order per node), and calls whose node is still missing a second later are dropped.
+  const waiting = new Map(), arrivals = new MutationObserver(() => wake());
+  const wake = () => {
+    const now = performance.now();
+    for (const [id, fs] of waiting) {
+      const node = el(id);
+      if (!node) { const live = fs.filter(([, t]) => now - t < 1000); live.length ? waiting.set(id, live) : waiting.delete(id); continue; }
+      waiting.delete(id);
+      for (const [f] of fs) { try { f(node); } catch (e) { console.error(e); } }
+    }
+    if (!waiting.size) arrivals.disconnect();
+  };
+  const withNode = (id, f) => {
+    const node = el(id);
+    if (node && !waiting.has(id)) return f(node);
+    if (!waiting.size) arrivals.observe(document.body, {childList: true, subtree: true});
+    waiting.has(id) ? waiting.get(id).push([f, performance.now()]) : waiting.set(id, [[f, performance.now()]]);
+    if (node) wake();
+  };
   const isDoc = x => !x || x === window || x === document || x === document.body || x === document.documentElement || x === document.scrollingElement;
   const scrollable = x => x instanceof Element && x.scrollHeight > x.clientHeight + 1 && /(auto|scroll|overlay)/.test(getComputedStyle(x).overflowY || '');
   const defaultHost = () => [...document.querySelectorAll('.chat-container')].at(-1) || document.scrollingElement || document.documentElement;
@@ -11,21 +29,115 @@
   const sticky = node => { const x = scrollHost(node), d = document.scrollingElement || document.documentElement; return isDoc(x) ? window.innerHeight + window.scrollY >= d.scrollHeight - 160 : x.scrollTop + x.clientHeight >= x.scrollHeight - 160; };
   const scrollBottom = (node=null, n=8) => { const x = scrollHost(node), d = document.scrollingElement || document.documentElement; isDoc(x) ? window.scrollTo({top: d.scrollHeight, behavior: 'auto'}) : x.scrollTop = x.scrollHeight; if (n > 0) requestAnimationFrame(() => scrollBottom(x, n - 1)); };
 
-  const md = window.markdownit({
-    html: false,
-    linkify: true,
-    breaks: true,
-    highlight: (s, l) => {
+  // Small LRU keyed by a content hash: re-renders reuse highlighted code, KaTeX and mermaid output.
+  const lru = (max, m=new Map()) => ({get: k => { const v = m.get(k); if (v !== undefined) m.delete(k), m.set(k, v); return v; }, set: (k, v) => { m.delete(k); m.set(k, v); if (m.size > max) m.delete(m.keys().next().value); return v; }});
+  const hash = s => { let a = 0xdeadbeef, b = 0x41c6ce57; for (let i = 0; i < s.length; i++) { const c = s.charCodeAt(i); a = Math.imul(a ^ c, 2654435761); b = Math.imul(b ^ c, 1597334677); } a = Math.imul(a ^ (a >>> 16), 2246822507) ^ Math.imul(b ^ (b >>> 13), 3266489909); b = Math.imul(b ^ (b >>> 16), 2246822507) ^ Math.imul(a ^ (a >>> 13), 3266489909); return `${s.length}:${(4294967296 * (2097151 & b) + (a >>> 0)).toString(36)}`; };
+
+  // Self-contained (it is stringified into the worker pool), so it only touches the global object and kit it is given.
+  // Splits `src` into the HTML of the finished top-level blocks and the HTML of the open trailing block. Libraries
+  // arrive through `kit.load`: markdown-it and highlight.js on first use, KaTeX and language packs once `src` needs them.
+  const renderer = (g, kit) => {
+    const code = kit.lru(256), tex = kit.lru(512), a = kit.assets;
+    const esc = s => (s || '').replace(/[&<>"]/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;'}[c]));
+    const safe = t => { const n = ((t || '').match(/^\s*```/gm) || []).length; return n % 2 ? (t.endsWith('\n') ? t + '```' : t + '\n```') : (t || ''); };
+    const lineAt = (s, n) => { const re = /\r\n|\r|\n/g; let i = 0; for (; n > 0; n--) { if (!re.exec(s)) return -1; i = re.lastIndex; } return i; };
+    const highlight = (s, l) => {
       const c = l ? ` class="hljs language-${l}"` : ' class="hljs"';
-      if (!window.hljs) return `<pre><code${l ? ` class="language-${l}"` : ''}>${esc(s)}</code></pre>`;
+      if (!g.hljs) return `<pre><code${l ? ` class="language-${l}"` : ''}>${esc(s)}</code></pre>`;
       try {
-        const v = l && window.hljs.getLanguage(l) ? window.hljs.highlight(s, {language: l}).value : window.hljs.highlightAuto(s).value;
+        const v = l && g.hljs.getLanguage(l) ? g.hljs.highlight(s, {language: l}).value : g.hljs.highlightAuto(s).value;
         return `<pre><code${c}>${v}</code></pre>`;
       } catch {
         return `<pre><code${l ? ` class="language-${l}"` : ''}>${esc(s)}</code></pre>`;
       }
-    },
-  }).use(window.texmath, {engine: window.katex, delimiters: 'dollars', katexOptions: {throwOnError: false}}).enable(['table']);
+    };
+    const katex = {renderToString: (s, o) => { const k = `${o?.displayMode ? 1 : 0}:${kit.hash(s)}`; return tex.get(k) ?? tex.set(k, g.katex.renderToString(s, o)); }};
+    let md = null, math = false;
+    const build = () => {
+      math = !!(g.katex && g.texmath);
+      md = g.markdownit({
+        html: false,
+        linkify: true,
+        breaks: true,
+        highlight: (s, l) => { const k = `${l}:${kit.hash(s)}`; return code.get(k) ?? code.set(k, highlight(s, l)); },
+      }).enable(['table']);
+      if (math) md.use(g.texmath, {engine: katex, delimiters: 'dollars', katexOptions: {throwOnError: false}});
+    };
+    const needs = src => {
+      const out = g.markdownit ? [] : [...a.core];
+      if (!math && src.includes('$')) out.push(...a.math);
+      for (const [, l] of src.matchAll(/^ {0,3}(?:`{3,}|~{3,})[ \t]*([\w+#.-]+)/gm)) { const u = a.langs[l.toLowerCase()]; if (u && !g.hljs?.getLanguage(l)) out.push(u); }
+      return [...new Set(out)];
+    };
+    const run = (src, refs, partial) => {
+      if (!md || (!math && g.katex && g.texmath)) build();
+      const env = {}, tokens = md.parse(safe(src), env), html = t => md.renderer.render(t, md.options, env);
+      // Link reference definitions can retarget links in blocks that are already frozen, so a message
+      // that contains one is rebuilt once and then always rendered whole.
+      if (env.references && !refs && partial) return {rebuild: true};
+      refs = refs || !!env.references;
+      const tops = tokens.flatMap((t, i) => t.level === 0 && t.nesting >= 0 && t.map ? [i] : []);
+      // A block is frozen only once the next one has started on a complete line: a bare `#` still
+      // being typed may turn out to be paragraph text rather than a heading.
+      let cut = tops.length > 1 && !refs ? tops.at(-1) : 0;
+      if (cut && lineAt(src, tokens[cut].map[0] + 1) < 0) cut = 0;
+      // Nor past an unclosed `$$` display formula (like an unclosed fence): a blank line inside it splits it
+      // into paragraphs that would be frozen as text, so the block holding the opening `$$` stays in the tail.
+      const open = cut && math && (src.match(/\$\$/g) || []).length % 2 ? src.lastIndexOf('$$') : -1;
+      if (open >= 0) {
+        const line = (src.slice(0, open).match(/\r\n|\r|\n/g) || []).length;
+        let i = tops.length - 1;
+        while (i > 0 && tokens[tops[i]].map[0] > line) i--;
+        cut = i > 0 ? tops[i] : 0;
+      }
+      return {refs, at: cut ? lineAt(src, tokens[cut].map[0]) : 0, done: cut ? html(tokens.slice(0, cut)) : '', tail: html(cut ? tokens.slice(cut) : tokens)};
+    };
+    // `kit.load` is synchronous in a worker and returns a promise on the main thread.
+    return (src, refs, partial) => { const want = needs(src), p = want.length && kit.load(want); return p ? p.then(() => run(src, refs, partial)) : run(src, refs, partial); };
+  };
+
+  // Library URLs from `window.chat7Assets`, made absolute so blob-URL workers can import them.
+  const A = JSON.parse(JSON.stringify(window.chat7Assets || {core: [], math: [], mathCss: [], mermaid: [], langs: {}}), (k, v) => typeof v === 'string' ? new URL(v, document.baseURI).href : v);
+  const scripts = new Map();
+  const script = u => scripts.get(u) || scripts.set(u, new Promise(done => { const s = document.createElement('script'); s.src = u; s.onload = s.onerror = done; document.head.appendChild(s); })).get(u);
+  const loadHere = urls => urls.reduce((p, u) => p.then(() => script(u)), Promise.resolve());
+  const styles = new Set();
+  const style = u => { if (styles.has(u)) return; styles.add(u); const l = document.createElement('link'); l.rel = 'stylesheet'; l.href = u; document.head.appendChild(l); };
+
+  // Parsing and highlighting run in a small pool of workers that import the libraries themselves;
+  // without workers, or if one fails to boot, the page renders on the main thread.
+  const workerMain = (renderer, kit) => {
+    const seen = new Set();
+    kit.load = urls => urls.forEach(u => { if (seen.has(u)) return; seen.add(u); try { importScripts(u); } catch (e) { console.error(e); } });
+    const layout = renderer(self, kit);
+    self.onmessage = e => { try { self.postMessage({id: e.data.id, out: layout(...e.data.args)}); } catch (err) { self.postMessage({id: e.data.id, error: String(err)}); } };
+  };
+  const pool = {size: Math.max(1, Math.min(4, (navigator.hardwareConcurrency || 2) - 1)), workers: [], jobs: new Map(), seq: 0, url: '', dead: !window.Worker || !window.chat7Assets};
+  let local = null;
+  const layoutHere = args => (local || (local = renderer(window, {lru, hash, assets: A, load: loadHere})))(...args);
+  const spawn = () => {
+    pool.url = pool.url || URL.createObjectURL(new Blob([`(${workerMain})(${renderer}, {lru: ${lru}, hash: ${hash}, assets: ${JSON.stringify(A)}});`], {type: 'text/javascript'}));
+    const w = new Worker(pool.url);
+    w.busy = 0;
+    w.onmessage = e => { const job = pool.jobs.get(e.data.id); if (!job) return; pool.jobs.delete(e.data.id); w.busy--; e.data.error ? job.reject(new Error(e.data.error)) : job.resolve(e.data.out); };
+    w.onerror = e => {
+      e.preventDefault();
+      pool.dead = true;
+      pool.workers.forEach(x => x.terminate());
+      pool.workers = [];
+      for (const [id, job] of pool.jobs) { pool.jobs.delete(id); try { job.resolve(layoutHere(job.args)); } catch (err) { job.reject(err); } }
+    };
+    pool.workers.push(w);
+    return w;
+  };
+  const layout = (...args) => {
+    if (!pool.dead) try {
+      const idle = pool.workers.reduce((a, w) => !a || w.busy < a.busy ? w : a, null), w = idle && (!idle.busy || pool.workers.length >= pool.size) ? idle : spawn(), id = ++pool.seq;
+      w.busy++;
+      return new Promise((resolve, reject) => { pool.jobs.set(id, {resolve, reject, args}); w.postMessage({id, args}); });
+    } catch (e) { console.error(e); pool.dead = true; }
+    return Promise.resolve().then(() => layoutHere(args));
+  };
 
   let mermaidReady = false;
   const initMermaid = () => { if (!window.mermaid || mermaidReady) return; window.mermaid.initialize({startOnLoad: false, securityLevel: 'loose', theme: 'dark', flowchart: {htmlLabels: true}}); mermaidReady = true; };
@@ -38,8 +150,8 @@
     } catch (e) { console.error(e); }
   };
 
-  const bindCodeCopy = root => {
-    root.querySelectorAll('pre').forEach(pre => {
+  const bindCodeCopy = nodes => {
+    pick(nodes, 'pre').forEach(pre => {
       if (pre.querySelector('.code-copy-btn')) return;
       const code = pre.querySelector('code'); if (!code) return;
       const btn = document.createElement('button');
@@ -108,22 +220,28 @@
     if (!x.timer) arm(node, x.started ? B.tick : Math.max(0, x.startAt + B.start - now));
   };
   const finish = node => { const x = state(node), now = performance.now(); x.done = true; x.drainAt = 0; x.drainLen = 0; x.drainPos = 0; x.drainRate = 0; if (x.timer) clearTimeout(x.timer), x.timer = 0; if (!x.startAt) x.startAt = now; x.buf.length ? arm(node, 0) : schedule(node); };
-  const mermaidize = async root => {
+  const diagrams = lru(64);
+  const mermaidize = async roots => {
     const nodes = [];
-    root.querySelectorAll('pre > code').forEach(code => {
+    pick(roots, 'pre > code').forEach(code => {
       if (!/\blanguage-mermaid\b/.test(code.className || '')) return;
-      const box = document.createElement('div');
+      const box = document.createElement('div'), src = code.textContent || '', key = hash(src), svg = diagrams.get(key);
       box.className = 'mermaid';
-      box.textContent = code.textContent || '';
       code.parentElement.replaceWith(box);
+      if (svg) { box.innerHTML = svg; box.dataset.processed = 'true'; return; }
+      box.textContent = src;
+      box._chat7Key = key;
       nodes.push(box);
     });
-    if (!nodes.length || !window.mermaid) return;
+    if (!nodes.length) return;
+    await loadHere(A.mermaid);
+    if (!window.mermaid) return;
     try { initMermaid(); await window.mermaid.run({nodes}); } catch (e) { console.error(e); }
+    nodes.forEach(box => { if (box.querySelector('svg') && !box.querySelector('svg[aria-roledescription="error"]')) diagrams.set(box._chat7Key, box.innerHTML); });
   };
 
-  const wrapTables = root => {
-    root.querySelectorAll('table').forEach(table => {
+  const wrapTables = nodes => {
+    pick(nodes, 'table').forEach(table => {
       if (table.parentElement?.classList.contains('chat7-table-wrap')) return;
       const wrap = document.createElement('div');
       wrap.className = 'chat7-table-wrap';
@@ -132,15 +250,40 @@
     });
   };
 
-  const decorateLinks = root => {
-    root.querySelectorAll('a[href]').forEach(a => {
+  const decorateLinks = nodes => {
+    pick(nodes, 'a[href]').forEach(a => {
       a.target = '_blank';
       a.rel = 'noopener noreferrer';
     });
   };
 
-  const decorateMedia = root => {
-    root.querySelectorAll('img').forEach(img => { img.loading = 'lazy'; });
+  const decorateMedia = nodes => {
+    pick(nodes, 'img').forEach(img => { img.loading = 'lazy'; });
+  };
+
+  const decorate = async (nodes, final) => {
+    if (!nodes.length) return;
+    if (pick(nodes, '.katex').length) A.mathCss.forEach(style);
+    await mermaidize(nodes);
+    wrapTables(nodes);
+    decorateLinks(nodes);
+    decorateMedia(nodes);
+    if (final) bindCodeCopy(nodes);
+  };
+
+  // Finished top-level blocks are frozen as DOM nodes before a comment marker; only the source after
+  // `at` (the open trailing block) is re-parsed and re-rendered on each frame.
+  const blocks = node => {
+    let b = node._chat7Blocks;
+    if (b && b.mark.parentNode === node) return b;
+    b = node._chat7Blocks = {at: 0, refs: false, mark: document.createComment('chat7-tail')};
+    node.replaceChildren(b.mark);
+    return b;
+  };
+  const emit = (node, html, before=null) => {
+    const f = window.DOMPurify.sanitize(html, {USE_PROFILES: {html: true, svg: true, mathMl: true}, RETURN_DOM_FRAGMENT: true}), out = [...f.childNodes];
+    node.insertBefore(f, before);
+    return out;
   };
 
   const render = async node => {
@@ -151,12 +294,20 @@
     node._chat7Rendering = true;
     node._chat7Dirty = false;
     try {
-      node.innerHTML = window.DOMPurify.sanitize(md.render(safe(node._chat7Markdown || '')), {USE_PROFILES: {html: true, svg: true, mathMl: true}});
-      await mermaidize(node);
-      wrapTables(node);
-      decorateLinks(node);
-      decorateMedia(node);
-      if (!active) bindCodeCopy(node);
+      let b = blocks(node), r = await layout((node._chat7Markdown || '').slice(b.at), b.refs, b.at > 0);
+      if (r.rebuild && node._chat7Blocks === b) {
+        r = await layout(node._chat7Markdown || '', true, false);
+        if (node._chat7Blocks === b) node._chat7Blocks = null, b = blocks(node);
+      }
+      // The text may have been replaced while a worker was busy; the next frame picks it up.
+      if (node._chat7Blocks !== b) return void (node._chat7Dirty = true);
+      b.refs = r.refs;
+      while (b.mark.nextSibling) b.mark.nextSibling.remove();
+      const done = r.done ? emit(node, r.done, b.mark) : [];
+      b.at += r.at;
+      const tail = emit(node, r.tail);
+      await decorate(done, true);
+      await decorate(tail, !active);
       if (atBottom) scrollBottom(node);
     } finally {
       node._chat7NextRenderAt = performance.now() + B.render;
@@ -167,15 +318,72 @@
 
   const schedule = node => { if (!node) return; node._chat7Dirty = true; if (node._chat7Frame || node._chat7Rendering || node._chat7RenderTimer) return; const run = () => { node._chat7RenderTimer = 0; node._chat7Frame = requestAnimationFrame(() => render(node)); }, dt = Math.max(0, (node._chat7NextRenderAt || 0) - performance.now()); dt ? node._chat7RenderTimer = setTimeout(run, dt) : run(); };
 
+  // Transcript virtualization: `.chat7-slot` placeholders that come within a screen of the viewport ask the
+  // server to mount their message; mounted ones three screens away are measured and handed back, so their
+  // placeholder keeps the real height. Unmeasured placeholders use the server's `data-estimate`.
+  const slots = {heights: new Map(), seen: new WeakSet(), root: undefined, near: null, far: null, mount: new Set(), unmount: new Set(), timer: 0};
+  const slotFlush = () => {
+    slots.timer = 0;
+    const mount = [...slots.mount], unmount = [...slots.unmount];
+    slots.mount.clear(); slots.unmount.clear();
+    if ((mount.length || unmount.length) && typeof emitEvent === 'function') emitEvent('chat7_slots', {mount, unmount});
+  };
+  const slotWant = (kind, token) => { (kind === 'mount' ? slots.unmount : slots.mount).delete(token); slots[kind].add(token); if (!slots.timer) slots.timer = setTimeout(slotFlush, 50); };
+  const mounted = slot => slot.childElementCount > 0;
+  const observeSlots = () => {
+    const all = [...document.querySelectorAll('.chat7-slot')], host = all.length ? scrollHost(all[0]) : null, root = isDoc(host) ? null : host;
+    if (!all.length) return;
+    if (slots.root !== root) {
+      slots.near?.disconnect(); slots.far?.disconnect();
+      slots.seen = new WeakSet();
+      slots.root = root;
+      slots.near = new IntersectionObserver(es => es.forEach(e => { if (e.isIntersecting && !mounted(e.target)) slotWant('mount', e.target.dataset.token); }), {root, rootMargin: '100% 0px'});
+      slots.far = new IntersectionObserver(es => es.forEach(e => {
+        if (e.isIntersecting || !mounted(e.target)) return;
+        const h = e.target.getBoundingClientRect().height;
+        slots.heights.set(e.target.dataset.token, h);
+        e.target.style.minHeight = `${h}px`;
+        slotWant('unmount', e.target.dataset.token);
+      }), {root, rootMargin: '300% 0px'});
+    }
+    all.forEach(slot => {
+      if (slots.seen.has(slot)) return;
+      slots.seen.add(slot);
+      if (!mounted(slot)) slot.style.minHeight = `${slots.heights.get(slot.dataset.token) || +slot.dataset.estimate || 80}px`;
+      slots.near.observe(slot); slots.far.observe(slot);
+    });
+  };
+  const slotsMounted = tokens => tokens.forEach(t => { const slot = document.querySelector(`.chat7-slot[data-token="${CSS.escape(t)}"]`); if (slot) slot.style.minHeight = ''; });
+
+  // Server calls arrive as batches of [method, ...args] on `window.chat7q` (queued there until this script loads).
+  const dispatch = () => {
+    const q = window.chat7q || [];
+    window.chat7q = [];
+    for (const batch of q) for (const [method, ...args] of batch) { try { window.chat7[method]?.(...args); } catch (e) { console.error(e); } }
+  };
+
   window.chat7 = {
-    setMarkdown: (id, text, now=false) => withNode(id, node => { resetStream(node); node._chat7Markdown = text || ''; now ? render(node) : schedule(node); }),
+    dispatch,
+    setMarkdown: (id, text, now=false) => withNode(id, node => { resetStream(node); node._chat7Blocks = null; node._chat7Load = ''; node._chat7Markdown = text || ''; now ? render(node) : schedule(node); }),
+    loadMarkdown: (id, url) => withNode(id, node => {
+      resetStream(node); node._chat7Blocks = null; node._chat7Load = url;
+      fetch(url, {credentials: 'same-origin'}).then(r => r.ok ? r.text() : Promise.reject(new Error(`${r.status} ${url}`))).then(text => {
+        if (node._chat7Load !== url) return;
+        node._chat7Load = ''; node._chat7Markdown = text; render(node);
+      }).catch(e => { console.error(e); if (node._chat7Load === url && typeof emitEvent === 'function') emitEvent('chat7_markdown_miss', {id}); });
+    }),
     appendMarkdown: (id, chunk) => { if (!chunk) return; withNode(id, node => { node._chat7Markdown = (node._chat7Markdown || '') + chunk; schedule(node); }); },
     appendMarkdownBuffered: (id, chunk) => { if (!chunk) return; withNode(id, node => queue(node, chunk)); },
     finishMarkdownBuffered: id => withNode(id, node => finish(node)),
-    clearMarkdown: id => withNode(id, node => { resetStream(node); node._chat7Markdown = ''; schedule(node); }),
+    clearMarkdown: id => withNode(id, node => { resetStream(node); node._chat7Blocks = null; node._chat7Load = ''; node._chat7Markdown = ''; schedule(node); }),
     renderNow: id => withNode(id, node => render(node)),
     getMarkdown: id => { const node = el(id); return node ? (node._chat7Markdown || '') : ''; },
     copyMarkdown: (id, btnId=null) => copy(window.chat7.getMarkdown(id), btnId),
     scrollBottom: () => scrollBottom(),
+    focus: id => withNode(id, node => (node.matches('input, textarea') ? node : node.querySelector('input, textarea'))?.focus()),
+    reveal: id => withNode(id, node => node.scrollIntoView({block: 'nearest'})),
+    observeSlots: () => requestAnimationFrame(observeSlots),
+    slotsMounted: tokens => requestAnimationFrame(() => slotsMounted(tokens || [])),
   };
+  dispatch();
 })();
\ No newline at end of file